@@ -3,22 +3,31 @@ import shutil
 import sys
 import time
 import multiprocessing
+import multiprocessing.connection
 import numpy as np
 import json
-from collections import namedtuple
+from collections import namedtuple, Counter
 import pickle
 import zmq
 import pyproj
 import psutil
 import struct
+import tempfile
 import concurrent.futures
+import heapq
+import itertools
 import argparse
+import uuid
 from py3dtiles.points.transformations import rotation_matrix, angle_between_vectors, vector_product, inverse_matrix, scale_matrix, translation_matrix
-from py3dtiles.points.utils import compute_spacing, name_to_filename
+from py3dtiles.points.utils import compute_spacing, name_to_filename, points_count, points_frame_count, split_points_batch
 from py3dtiles.points.node import Node
 from py3dtiles import TileContentReader
-from py3dtiles.points.shared_node_store import SharedNodeStore
+from py3dtiles.points.shared_node_store import SharedNodeStore, PREFETCH_COUNT
+from py3dtiles.points.job_controller import JobController
+from py3dtiles.points import codec
+from py3dtiles.points import external_sort
 import py3dtiles.points.task.las_reader as las_reader
+import py3dtiles.points.task.laz_reader as laz_reader
 import py3dtiles.points.task.xyz_reader as xyz_reader
 import py3dtiles.points.task.node_process as node_process
 import py3dtiles.points.task.pnts_writer as pnts_writer
@@ -26,11 +35,28 @@ import py3dtiles.points.task.pnts_writer as pnts_writer
 
 total_memory_MB = int(psutil.virtual_memory().total / (1024 * 1024))
 
+# seconds a remote worker waits for the conversion parameters
+CONFIG_TIMEOUT = 60
+
+# default: the nodes are built top-down by the workers, as the points are read
+# external-sort: the points are sorted on disk, then the nodes are built bottom-up
+MODES = ('default', 'external-sort')
+
 
 class SrsInMissingException(Exception):
     pass
 
 
+def get_reader(filename):
+    """Returns the reader module to use for filename, based on its extension"""
+    _, ext = os.path.splitext(filename)
+    if ext == '.las':
+        return las_reader
+    elif ext == '.laz':
+        return laz_reader
+    return xyz_reader
+
+
 def write_tileset(in_folder, out_folder, octree_metadata, offset, scale, projection, rotation_matrix, include_rgb):
     # compute tile transform matrix
     if rotation_matrix is None:
@@ -98,12 +124,35 @@ def make_rotation_matrix(z1, z2):
 OctreeMetadata = namedtuple('OctreeMetadata', ['aabb', 'spacing', 'scale'])
 
 
-def zmq_process(activity_graph, projection, node_store, octree_metadata, folder, write_rgb, verbosity):
+def local_endpoint(working_dir):
+    """Returns an ipc endpoint unique to the conversion using working_dir"""
+    path = os.path.join(os.path.abspath(working_dir), 'zmq.sock')
+    # unix sockets paths are limited to ~100 chars
+    if len(path) > 100:
+        path = os.path.join(tempfile.gettempdir(), 'py3dtiles-{}.sock'.format(uuid.uuid4().hex))
+    return 'ipc://{}'.format(path)
+
+
+def zmq_process(endpoint, activity_graph, projection, node_store, octree_metadata, folder, write_rgb, verbosity,
+                staging_dir=None, threads=1, config_timeout=CONFIG_TIMEOUT):
     context = zmq.Context()
 
     # Socket to receive messages on
     skt = context.socket(zmq.DEALER)
-    skt.connect('ipc:///tmp/py3dtiles1')
+    skt.connect(endpoint)
+
+    if octree_metadata is None:
+        # remote worker (see remote_zmq_process)
+        skt.send_multipart([b'config'])
+        # the conversion may be over, or not reachable
+        config = pickle.loads(skt.recv()) if skt.poll(config_timeout * 1000) else b'shutdown'
+        if config == b'shutdown':
+            skt.close(linger=0)
+            return
+        projection = config['projection']
+        octree_metadata = config['octree_metadata']
+        write_rgb = config['write_rgb']
+        staging_dir = config['staging_dir']
 
     startup_time = time.time()
     idle_time = 0
@@ -111,6 +160,11 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
     if activity_graph:
         activity = open('activity.{}.csv'.format(os.getpid()), 'w')
 
+    # the nodes processed last, kept decoded for their next job
+    catalog_cache = node_process.CatalogCache()
+    # to process the sibling subtrees of the nodes in parallel
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
     # notify we're ready
     skt.send_multipart([b''])
 
@@ -122,22 +176,22 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
         after = time.time() - startup_time
 
         idle_time += after - before
-        command = skt.recv_multipart()
-        delta = time.time() - pickle.loads(command[0])
+        # points batches are used in place, from the zmq frames buffers
+        command = skt.recv_multipart(copy=False)
+        delta = time.time() - pickle.loads(command[0].bytes)
         if delta > 0.01 and verbosity >= 1:
             print('{} / {} : Delta time: {}'.format(os.getpid(), round(after, 2), round(delta, 3)))
         command = command[1:]
 
         if len(command) == 1:
-            command = pickle.loads(command[0])
+            command = pickle.loads(command[0].bytes)
             command_type = 1
 
             if command == b'shutdown':
                 # ack
                 break
 
-            _, ext = os.path.splitext(command['filename'])
-            init_reader_fn = las_reader.run if ext == '.las' else xyz_reader.run
+            init_reader_fn = get_reader(command['filename']).run
             init_reader_fn(
                 command['id'],
                 command['filename'],
@@ -145,10 +199,16 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
                 command['portion'],
                 skt,
                 projection,
-                verbosity)
-        elif command[0] == b'pnts':
+                verbosity,
+                staging_dir,
+                octree_metadata.aabb if command['morton_sort'] else None)
+        elif command[0].bytes == b'dictionary':
+            # sent before the first nodes compressed with it
+            codec.add_dictionary(command[1].bytes)
+            continue
+        elif command[0].bytes == b'pnts':
             command_type = 3
-            pnts_writer.run(skt, command[2], command[1], folder, write_rgb)
+            pnts_writer.run(skt, command[2].bytes, command[1].bytes, folder, write_rgb)
             skt.send_multipart([b''])
         else:
             command_type = 2
@@ -156,7 +216,10 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
                 command,
                 octree_metadata,
                 skt,
-                verbosity)
+                verbosity,
+                staging_dir,
+                catalog_cache,
+                executor)
 
         if activity_graph:
             print('{before}, {command_type}'.format(**locals()), file=activity)
@@ -167,6 +230,9 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
     if activity_graph:
         activity.close()
 
+    if executor is not None:
+        executor.shutdown()
+
     if verbosity >= 1:
         print('total: {} sec, idle: {}'.format(
             round(time.time() - startup_time, 1),
@@ -175,9 +241,30 @@ def zmq_process(activity_graph, projection, node_store, octree_metadata, folder,
     skt.send_multipart([b'halted'])
 
 
+def remote_zmq_process(endpoint, verbosity, threads=1, config_timeout=CONFIG_TIMEOUT):
+    """Runs a worker for a convert started on another host (see `convert --bind`)
+
+    The conversion parameters are requested from the main process. The .pnts
+    files are sent back to it, since the output folder may not be shared.
+    The worker exits if they're not received within config_timeout seconds.
+    """
+    zmq_process(endpoint, False, None, None, None, None, None, verbosity, threads=threads, config_timeout=config_timeout)
+
+
+def zmq_send_to_client(client, socket, message):
+    socket.send_multipart([client, pickle.dumps(time.time())] + message)
+
+
+def send_dictionary(client, socket, node_codec, clients_with_dictionary):
+    """Sends the zstd dictionary of node_codec to a worker that didn't receive it yet"""
+    if node_codec.dictionary is not None and client not in clients_with_dictionary:
+        zmq_send_to_client(client, socket, [b'dictionary', node_codec.dictionary])
+        clients_with_dictionary.add(client)
+
+
 def zmq_send_to_process(idle_clients, socket, message):
     assert idle_clients
-    socket.send_multipart([idle_clients.pop(), pickle.dumps(time.time())] + message)
+    zmq_send_to_client(idle_clients.pop(), socket, message)
 
 
 def zmq_send_to_all_process(idle_clients, socket, message):
@@ -201,6 +288,15 @@ def is_ancestor_in_list(ln, node_name, d):
     return False
 
 
+def get_node_owner(node_owners, name):
+    """Returns the worker that processed name, or its closest ancestor, last"""
+    for i in range(len(name), -1, -1):
+        owner = node_owners.get(name[0:i])
+        if owner is not None:
+            return owner
+    return None
+
+
 def can_pnts_be_written(name, finished_node, input_nodes, active_nodes):
     ln = len(name)
     return (
@@ -212,6 +308,8 @@ def can_pnts_be_written(name, finished_node, input_nodes, active_nodes):
 Reader = namedtuple('Reader', ['input', 'active'])
 NodeProcess = namedtuple('NodeProcess', ['input', 'active', 'inactive'])
 ToPnts = namedtuple('ToPnts', ['input', 'active'])
+# a pending points batch spilled on disk (see spill_tasks)
+SpilledBatch = namedtuple('SpilledBatch', ['key', 'point_count'])
 
 
 class State():
@@ -219,6 +317,8 @@ class State():
         self.reader = Reader(input=pointcloud_file_portions, active=[])
         self.node_process = NodeProcess(input={}, active={}, inactive=[])
         self.to_pnts = ToPnts(input=[], active=[])
+        # bytes of the points batches in node_process.input
+        self.pending_task_bytes = 0
 
     def print_debug(self):
         print('{:^16}|{:^8}|{:^8}|{:^8}'.format('Step', 'Input', 'Active', 'Inactive'))
@@ -239,10 +339,98 @@ class State():
             ''))
 
 
+def task_size(task):
+    return 0 if isinstance(task, SpilledBatch) else sum(len(f) for f in task)
+
+
+def spill_tasks(state, node_store, bytes_to_free):
+    """Spills the inline points batches of the nodes that will be processed last
+
+    Returns the freed bytes."""
+    freed = 0
+    # the deepest nodes are sent last to the workers
+    for name in sorted(state.node_process.input, key=len, reverse=True):
+        tasks = state.node_process.input[name][0]
+        for i, task in enumerate(tasks):
+            if freed >= bytes_to_free:
+                return freed
+            # staged batches are only a filename
+            if isinstance(task, SpilledBatch) or points_frame_count(task[0]) != 3:
+                continue
+            size = task_size(task)
+            tasks[i] = SpilledBatch(node_store.put_batch(b''.join(task)), points_count(task[0]))
+            state.pending_task_bytes -= size
+            freed += size
+    return freed
+
+
+def task_frames(state, node_store, task):
+    """Returns the frames of a pending task, reading it back if it was spilled"""
+    if isinstance(task, SpilledBatch):
+        return split_points_batch(memoryview(node_store.take_batch(task.key)))
+    state.pending_task_bytes -= task_size(task)
+    return task
+
+
 def can_queue_more_jobs(idles):
     return idles
 
 
+def per_file_folder_names(files):
+    """Returns the name of the subfolder of each file: its name without extension
+
+    Files with the same name (e.g. a/tile.las and b/tile.las, or x.las and
+    x.laz) get a -<n> suffix, in their order, so that their tilesets don't
+    overwrite each other.
+    """
+    names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    counts = Counter(names)
+    used = set(names)
+    for i, name in enumerate(names):
+        if counts[name] > 1:
+            suffix = 1
+            while '{}-{}'.format(name, suffix) in used:
+                suffix += 1
+            names[i] = '{}-{}'.format(name, suffix)
+            used.add(names[i])
+    return names
+
+
+def convert_per_file(files, outfolder, max_concurrent_runs, jobs, cache_size, **kwargs):
+    """Converts each file to its own tileset, in a subfolder of outfolder (see per_file_folder_names)
+
+    At most max_concurrent_runs conversions run at the same time, each with
+    its share of the jobs and of the cache size.
+    """
+    os.makedirs(outfolder, exist_ok=True)
+    run_count = max(1, min(max_concurrent_runs, len(files)))
+    pending = list(zip(files, per_file_folder_names(files)))
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < run_count:
+            filename, name = pending.pop(0)
+            p = multiprocessing.Process(
+                target=convert,
+                args=(filename, ),
+                kwargs=dict(
+                    kwargs,
+                    outfolder=os.path.join(outfolder, name),
+                    jobs=max(1, jobs // run_count),
+                    cache_size=max(1, cache_size // run_count)))
+            p.start()
+            running.append((filename, p))
+
+        multiprocessing.connection.wait([p.sentinel for _, p in running])
+        for filename, p in [r for r in running if not r[1].is_alive()]:
+            running.remove((filename, p))
+            if p.exitcode != 0:
+                failed.append(filename)
+
+    if failed:
+        raise Exception('Conversion failed for {}'.format(', '.join(failed)))
+
+
 def init_parser(subparser, str2bool):
 
     parser = subparser.add_parser(
@@ -252,7 +440,7 @@ def init_parser(subparser, str2bool):
     parser.add_argument(
         'files',
         nargs='+',
-        help='Filenames to process. The file must use the .las or .xyz format.')
+        help='Filenames to process. The file must use the .las, .laz or .xyz format.')
     parser.add_argument(
         '--out',
         type=str,
@@ -268,9 +456,15 @@ def init_parser(subparser, str2bool):
         help='The number of parallel jobs to start. Default to the number of cpu.',
         default=multiprocessing.cpu_count(),
         type=int)
+    parser.add_argument(
+        '--threads',
+        help='The number of threads of each job, processing sibling subtrees of the nodes in parallel. '
+             'Fewer jobs with more threads use less memory.',
+        default=1,
+        type=int)
     parser.add_argument(
         '--cache_size',
-        help='Cache size in MB. Default to available memory / 10.',
+        help='Memory used by the main process for the nodes and the pending points, in MB. Default to available memory / 10.',
         default=int(total_memory_MB / 10),
         type=int)
     parser.add_argument(
@@ -293,6 +487,62 @@ def init_parser(subparser, str2bool):
     parser.add_argument(
         '--color_scale',
         help='Force color scale', type=float)
+    parser.add_argument(
+        '--staging_dir',
+        help='Folder where the workers write the points batches they exchange, so that only their '
+             'filename goes through the main process (e.g. a folder in /dev/shm). '
+             'By default, points batches are sent through the main process.',
+        type=str)
+    parser.add_argument(
+        '--single_pass',
+        help='Read .xyz files only once, instead of parsing them a first time to compute their aabb. '
+             'The aabb comes from --aabb, from a <file>.aabb sidecar or from a sample of the file. '
+             'The conversion fails if points are outside of it.',
+        type=str2bool, default=False)
+    parser.add_argument(
+        '--aabb',
+        help='Aabb of the .xyz files used with --single_pass: xmin ymin zmin xmax ymax zmax',
+        nargs=6, type=float)
+    parser.add_argument(
+        '--bind',
+        help='Additional endpoint (e.g. tcp://*:5555) where workers started on other hosts with '
+             '`py3dtiles worker --connect` can join the conversion. Input files must be readable '
+             'with the same path on these hosts.',
+        type=str)
+    parser.add_argument(
+        '--per_file',
+        help='Convert each file to its own tileset, in a subfolder of --out (they can be merged afterwards '
+             'with py3dtiles merge).',
+        type=str2bool, default=False)
+    parser.add_argument(
+        '--max_concurrent_runs',
+        help='With --per_file, the number of conversions running side by side. They share the jobs and the cache.',
+        default=1, type=int)
+    parser.add_argument(
+        '--morton_sort',
+        help='Sort the points read by Morton code, so that the nodes receive spatially coherent batches '
+             'that they split by child without scanning them.',
+        type=str2bool, default=False)
+    parser.add_argument(
+        '--compression',
+        help='Compression of the nodes kept by the main process. none is faster with a fast disk, '
+             'zstd (requires zstandard) compresses best, e.g. for a network storage.',
+        choices=codec.CODECS, default='lz4')
+    parser.add_argument(
+        '--compression_benchmark',
+        help='Print the ratio and speed of each compression on the first nodes of the conversion.',
+        type=str2bool, default=False)
+    parser.add_argument(
+        '--mode',
+        help='external-sort writes the points sorted by Morton code on disk first, then builds the tiles '
+             'bottom-up with bounded memory, for pointclouds too big for the default mode. It needs twice '
+             'the size of the points (15 bytes each) of free disk space in the output folder.',
+        choices=MODES, default='default')
+    parser.add_argument(
+        '--metadata_cache',
+        help='Cache the metadata of the .las files in this file (e.g. {}), so that the next conversions of '
+             'the same files don\'t read their headers again.'.format(las_reader.METADATA_CACHE),
+        type=str)
 
 
 def main(args):
@@ -301,6 +551,7 @@ def main(args):
                        outfolder=args.out,
                        overwrite=args.overwrite,
                        jobs=args.jobs,
+                       threads=args.threads,
                        cache_size=args.cache_size,
                        srs_out=args.srs_out,
                        srs_in=args.srs_in,
@@ -309,6 +560,17 @@ def main(args):
                        rgb=args.rgb,
                        graph=args.graph,
                        color_scale=args.color_scale,
+                       staging_dir=args.staging_dir,
+                       single_pass=args.single_pass,
+                       aabb=args.aabb,
+                       bind=args.bind,
+                       per_file=args.per_file,
+                       max_concurrent_runs=args.max_concurrent_runs,
+                       morton_sort=args.morton_sort,
+                       compression=args.compression,
+                       compression_benchmark=args.compression_benchmark,
+                       mode=args.mode,
+                       metadata_cache=args.metadata_cache,
                        verbose=args.verbose)
     except SrsInMissingException:
         print('No SRS information in input files, you should specify it with --srs_in')
@@ -319,6 +581,7 @@ def convert(files,
             outfolder='./3dtiles',
             overwrite=False,
             jobs=multiprocessing.cpu_count(),
+            threads=1,
             cache_size=int(total_memory_MB / 10),
             srs_out=None,
             srs_in=None,
@@ -327,12 +590,23 @@ def convert(files,
             rgb=True,
             graph=False,
             color_scale=None,
+            staging_dir=None,
+            single_pass=False,
+            aabb=None,
+            bind=None,
+            per_file=False,
+            max_concurrent_runs=1,
+            morton_sort=False,
+            compression='lz4',
+            compression_benchmark=False,
+            mode='default',
+            metadata_cache=None,
             verbose=False):
     """convert
 
-    Convert pointclouds (xyz or las) to 3dtiles tileset containing pnts node
+    Convert pointclouds (xyz, las or laz) to 3dtiles tileset containing pnts node
 
-    :param files: Filenames to process. The file must use the .las or .xyz format.
+    :param files: Filenames to process. The file must use the .las, .laz or .xyz format.
     :type files: list of str, or str
     :param outfolder: The folder where the resulting tileset will be written.
     :type outfolder: path-like object
@@ -340,7 +614,9 @@ def convert(files,
     :type overwrite: bool
     :param jobs: The number of parallel jobs to start. Default to the number of cpu.
     :type jobs: int
-    :param cache_size: Cache size in MB. Default to available memory / 10.
+    :param threads: The number of threads of each job, processing sibling subtrees of the nodes in parallel.
+    :type threads: int
+    :param cache_size: Memory used by the main process for the nodes and the pending points batches, in MB. Beyond that, they're spilled on disk. Default to available memory / 10.
     :type cache_size: int
     :param srs_out: SRS to convert the output with (numeric part of the EPSG code)
     :type srs_out: int or str
@@ -356,19 +632,75 @@ def convert(files,
     :type graph: bool
     :param color_scale: Force color scale
     :type color_scale: float
+    :param staging_dir: Folder where the workers write the points batches they exchange, so that only
+                        their filename goes through the main process.
+    :type staging_dir: path-like object
+    :param single_pass: Read .xyz files only once, with portions made by splitting the files by size.
+    :type single_pass: bool
+    :param aabb: Aabb of the .xyz files used by single_pass (else read from a <file>.aabb sidecar or sampled)
+    :type aabb: list of 6 float: xmin, ymin, zmin, xmax, ymax, zmax
+    :param bind: Additional endpoint where workers started on other hosts (see `py3dtiles worker`) can join
+                 the conversion. With jobs=0, all the work is done by these workers.
+    :type bind: str (zmq endpoint, e.g. tcp://*:5555)
+    :param per_file: Convert each file to its own tileset, in a subfolder of outfolder named after the file
+                     (with a -<n> suffix for the files with the same name).
+    :type per_file: bool
+    :param max_concurrent_runs: With per_file, the number of conversions running side by side. They share
+                                the jobs and the cache size (graph is only supported with 1 run at a time).
+    :type max_concurrent_runs: int
+    :param morton_sort: Sort the points read by Morton code, so that the nodes receive spatially coherent batches.
+    :type morton_sort: bool
+    :param compression: Compression of the nodes kept by the main process: none, lz4, lz4hc or zstd
+                        (requires zstandard).
+    :type compression: str
+    :param compression_benchmark: Print the ratio and speed of each compression on the first nodes.
+    :type compression_benchmark: bool
+    :param mode: default, or external-sort to sort the points on disk and build the tiles bottom-up
+                 with bounded memory (cache_size, threads, morton_sort, compression and bind don't apply).
+    :type mode: str
+    :param metadata_cache: File where the metadata of the .las files are cached between conversions
+                           (see las_reader.METADATA_CACHE). By default, they're not cached.
+    :type metadata_cache: path-like object
 
     :raises SrsInMissingException: if py3dtiles couldn't find srs informations in input files and srs_in is not specified
+    :raises OutsideAabbException: with single_pass, if points of the .xyz files are outside their aabb
 
 
     """
 
     # allow str directly if only one input
     files = [files] if isinstance(files, str) else files
+    # workers may run from another directory
+    files = [os.path.abspath(f) for f in files]
+
+    if mode not in MODES:
+        raise ValueError('Unknown mode {}, should be one of {}'.format(mode, ', '.join(MODES)))
+    if bind is not None and mode == 'external-sort':
+        raise Exception('bind can\'t be used with the external-sort mode')
+
+    if per_file:
+        if bind is not None:
+            raise Exception('bind can\'t be used with per_file')
+        return convert_per_file(
+            files, outfolder, max_concurrent_runs, jobs, cache_size,
+            overwrite=overwrite, threads=threads, srs_out=srs_out, srs_in=srs_in, fraction=fraction, benchmark=benchmark,
+            rgb=rgb, graph=graph and max_concurrent_runs == 1, color_scale=color_scale,
+            staging_dir=staging_dir, single_pass=single_pass, aabb=aabb, morton_sort=morton_sort, compression=compression,
+            compression_benchmark=compression_benchmark, mode=mode, metadata_cache=metadata_cache, verbose=verbose)
 
     # read all input files headers and determine the aabb/spacing
-    _, ext = os.path.splitext(files[0])
-    init_reader_fn = las_reader.init if ext == '.las' else xyz_reader.init
-    infos = init_reader_fn(files, color_scale=color_scale, srs_in=srs_in)
+    reader = get_reader(files[0])
+    reader_options = {}
+    if reader is las_reader:
+        reader_options = {'metadata_cache': metadata_cache}
+    if reader is xyz_reader and single_pass:
+        reader_options = {
+            'single_pass': True,
+            'aabb': np.array(aabb).reshape((2, 3)) if aabb is not None else None
+        }
+    job_controller = JobController(jobs)
+    infos = reader.init(files, color_scale=color_scale, srs_in=srs_in, portion_size=job_controller.portion_size(),
+                        **reader_options)
 
     avg_min = infos['avg_min']
     rotation_matrix = None
@@ -451,8 +783,6 @@ def convert(files,
     working_dir = os.path.join(outfolder, 'tmp')
     os.makedirs(working_dir)
 
-    node_store = SharedNodeStore(working_dir)
-
     if verbose >= 1:
         print('Summary:')
         print('  - points to process: {}'.format(infos['point_count']))
@@ -464,6 +794,35 @@ def convert(files,
 
     startup = time.time()
 
+    offset_scale = (-avg_min, root_scale, rotation_matrix[:3, :3].T if rotation_matrix is not None else None, infos['color_scale'])
+
+    if mode == 'external-sort':
+        points_in_pnts, point_count_delta = external_sort.run(
+            [(get_reader(f).run, f, portion) for f, portion in infos['portions']],
+            offset_scale, projection, octree_metadata, working_dir, outfolder, rgb, jobs, verbose)
+        infos['point_count'] += point_count_delta
+        assert points_in_pnts == infos['point_count'], '!!! Invalid point count in the written .pnts (expected: {}, was: {})'.format(
+            infos['point_count'], points_in_pnts)
+        if verbose >= 1:
+            print('Writing 3dtiles {}'.format(infos['avg_min']))
+        write_tileset(working_dir, outfolder, octree_metadata, avg_min, root_scale, projection, rotation_matrix, rgb)
+        shutil.rmtree(working_dir)
+        if verbose >= 1:
+            print('Done')
+        if benchmark is not None:
+            print('{},{},{},{}'.format(
+                benchmark,
+                ','.join([os.path.basename(f) for f in files]),
+                points_in_pnts,
+                round(time.time() - startup, 1)))
+        return
+
+    node_store = SharedNodeStore(working_dir, codec=codec.Codec(compression, keep_samples=compression_benchmark))
+
+    if staging_dir is not None:
+        os.makedirs(staging_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix='py3dtiles-', dir=staging_dir)
+
     initial_portion_count = len(infos['portions'])
 
     if graph:
@@ -472,6 +831,7 @@ def convert(files,
     def add_tasks_to_process(state, name, task, point_count):
         assert point_count > 0
         tasks_to_process = state.node_process.input
+        state.pending_task_bytes += task_size(task)
         if name not in tasks_to_process:
             tasks_to_process[name] = ([task], point_count)
         else:
@@ -484,16 +844,33 @@ def convert(files,
     previous_percent = 0
     points_in_pnts = 0
 
-    max_splitting_jobs_count = max(1, jobs // 2)
-
     # zmq setup
     context = zmq.Context()
 
     zmq_skt = context.socket(zmq.ROUTER)
-    zmq_skt.bind('ipc:///tmp/py3dtiles1')
-
+    endpoint = local_endpoint(working_dir)
+    zmq_skt.bind(endpoint)
+    if bind is not None:
+        zmq_skt.bind(bind)
+
+    # sent to the remote workers when they join
+    worker_config = pickle.dumps({
+        'projection': projection,
+        'octree_metadata': octree_metadata,
+        'write_rgb': rgb,
+        'staging_dir': staging_dir,
+    })
+
+    zmq_clients = set()
     zmq_idle_clients = []
 
+    # which worker processed each node last, and what it still has decoded
+    node_owners = {}
+    worker_catalog_caches = {}
+    node_job_started_at = {}
+    # the workers that received the zstd dictionary (see send_dictionary)
+    clients_with_dictionary = set()
+
     state = State(infos['portions'])
 
     zmq_processes_killed = -1
@@ -501,7 +878,8 @@ def convert(files,
     zmq_processes = [multiprocessing.Process(
         target=zmq_process,
         args=(
-            graph, projection, node_store, octree_metadata, outfolder, rgb, verbose)) for i in range(jobs)]
+            endpoint, graph, projection, node_store, octree_metadata, outfolder, rgb, verbose, staging_dir, threads))
+        for i in range(jobs)]
 
     for p in zmq_processes:
         p.start()
@@ -527,6 +905,7 @@ def convert(files,
             if len(result) == 1:
                 if len(result[0]) == 0:
                     assert client_id not in zmq_idle_clients
+                    zmq_clients.add(client_id)
                     zmq_idle_clients += [client_id]
 
                     if all_processes_busy:
@@ -535,6 +914,14 @@ def convert(files,
                 elif result[0] == b'halted':
                     zmq_processes_killed += 1
                     all_processes_busy = False
+                elif result[0] == b'config':
+                    if zmq_processes_killed >= 0:
+                        # too late to join
+                        zmq_skt.send_multipart([client_id, pickle.dumps(b'shutdown')])
+                    else:
+                        # a remote worker joins, it'll be idle once configured
+                        zmq_clients.add(client_id)
+                        zmq_skt.send_multipart([client_id, worker_config])
                 else:
                     result = pickle.loads(result[0])
                     processed_points += result['total']
@@ -545,7 +932,23 @@ def convert(files,
 
                     if result['name'][0:4] == b'root':
                         state.reader.active.remove(result['name'])
+                        # some readers only know an estimation of their portion point count
+                        point_count_delta = result.get('point_count_delta', 0)
+                        infos['point_count'] += point_count_delta
+                        points_in_progress += point_count_delta
+                        # they would be clamped in the wrong nodes (see xyz_reader.run)
+                        if result.get('outside_aabb', 0) > 0:
+                            for p in zmq_processes:
+                                p.terminate()
+                            raise xyz_reader.OutsideAabbException(
+                                '{} points are outside the aabb, use --aabb to give it'.format(result['outside_aabb']))
                     else:
+                        # the nodes of a job are processed one after the other
+                        job_done_at = time.time()
+                        job_controller.node_job_done(
+                            state.node_process.active[result['name']][1],
+                            job_done_at - node_job_started_at[client_id])
+                        node_job_started_at[client_id] = job_done_at
                         del state.node_process.active[result['name']]
 
                         if len(result['name']) > 0:
@@ -583,16 +986,24 @@ def convert(files,
             elif result[0] == b'pnts':
                 points_in_pnts += struct.unpack('>I', result[1])[0]
                 state.to_pnts.active.remove(result[2])
+                # remote workers send their tiles back
+                for i in range(3, len(result), 2):
+                    with open(name_to_filename(outfolder, result[i], '.pnts'), 'wb') as f:
+                        f.write(result[i + 1])
             else:
-                count = struct.unpack('>I', result[2])[0]
-                add_tasks_to_process(state, result[0], result[1], count)
+                # a points batch: the node name followed by the batch frames (see points_to_frames)
+                count = points_count(result[1])
+                add_tasks_to_process(state, result[0], result[1:], count)
 
         while state.to_pnts.input and can_queue_more_jobs(zmq_idle_clients):
             node_name = state.to_pnts.input.pop()
             datas = node_store.get(node_name)
             assert len(datas) > 0, '{} has no data??'.format(node_name)
-            zmq_send_to_process(zmq_idle_clients, zmq_skt, [b'pnts', node_name, datas])
+            client = zmq_idle_clients.pop()
+            send_dictionary(client, zmq_skt, node_store.codec, clients_with_dictionary)
+            zmq_send_to_client(client, zmq_skt, [b'pnts', node_name, datas])
             node_store.remove(node_name)
+            node_owners.pop(node_name, None)
             state.to_pnts.active.append(node_name)
 
         if can_queue_more_jobs(zmq_idle_clients):
@@ -600,8 +1011,14 @@ def convert(files,
                 [(k, v) for k, v in state.node_process.input.items() if k not in state.node_process.active],
                 key=lambda f: -len(f[0]))
 
+            pending_points = sum(v[1] for k, v in potential)
             while can_queue_more_jobs(zmq_idle_clients) and potential:
-                target_count = 100000
+                target_count = job_controller.node_job_size(pending_points, len(zmq_idle_clients))
+                client = zmq_idle_clients.pop()
+                catalog_cache = worker_catalog_caches.setdefault(client, node_process.CatalogCache())
+                # start with the nodes (or subtrees) this worker processed last
+                potential.sort(key=lambda f: get_node_owner(node_owners, f[0]) == client)
+
                 job_list = []
                 count = 0
                 idx = len(potential) - 1
@@ -609,10 +1026,17 @@ def convert(files,
                     name, (tasks, point_count) = potential[idx]
                     if name not in state.node_process.active:
                         count += point_count
+                        pending_points -= point_count
                         job_list += [name]
-                        job_list += [node_store.get(name)]
+                        if node_owners.get(name) == client and name in catalog_cache:
+                            job_list += [node_process.CACHED_NODE]
+                        else:
+                            job_list += [node_store.get(name)]
+                        catalog_cache.put(name)
+                        node_owners[name] = client
                         job_list += [struct.pack('>I', len(tasks))]
-                        job_list += tasks
+                        for task in tasks:
+                            job_list += task_frames(state, node_store, task)
                         del potential[idx]
                         del state.node_process.input[name]
                         state.node_process.active[name] = (len(tasks), point_count, now)
@@ -621,30 +1045,47 @@ def convert(files,
                             state.node_process.inactive.pop(state.node_process.inactive.index(name))
                     idx -= 1
 
-                if job_list:
-                    zmq_send_to_process(zmq_idle_clients, zmq_skt, job_list)
+                node_job_started_at[client] = time.time()
+                send_dictionary(client, zmq_skt, node_store.codec, clients_with_dictionary)
+                zmq_send_to_client(client, zmq_skt, job_list)
+
+        if job_controller.measure(len(zmq_clients), len(zmq_idle_clients)):
+            job_controller.update(
+                len(zmq_clients),
+                sum(v[1] for v in state.node_process.input.values()),
+                len(state.reader.input))
 
         while (state.reader.input
-               and (points_in_progress < 60000000 or not state.reader.active)
-               and len(state.reader.active) < max_splitting_jobs_count
+               and job_controller.can_admit_portion(
+                   state.reader.input[-1][1][1] - state.reader.input[-1][1][0],
+                   len(state.reader.active))
                and can_queue_more_jobs(zmq_idle_clients)):
             if verbose >= 1:
                 print('Submit next portion {}'.format(state.reader.input[-1]))
             _id = 'root_{}'.format(len(state.reader.input)).encode('ascii')
             file, portion = state.reader.input.pop()
             points_in_progress += portion[1] - portion[0]
+            job_controller.portion_admitted(portion[1] - portion[0])
 
             zmq_send_to_process(zmq_idle_clients, zmq_skt, [pickle.dumps({
                 'filename': file,
-                'offset_scale': (-avg_min, root_scale, rotation_matrix[:3, :3].T if rotation_matrix is not None else None, infos['color_scale']),
+                'offset_scale': offset_scale,
                 'portion': portion,
-                'id': _id
+                'id': _id,
+                'morton_sort': morton_sort,
             })])
 
             state.reader.active.append(_id)
 
+        if zmq_processes_killed >= 0 and zmq_idle_clients:
+            # remote workers that joined after the shutdown
+            zmq_send_to_all_process(zmq_idle_clients, zmq_skt, [pickle.dumps(b'shutdown')])
+
         # if at this point we have no work in progress => we're done
-        if len(zmq_idle_clients) == jobs or zmq_processes_killed == jobs:
+        # (waiting for all the local workers, or for a first remote one)
+        all_clients_idle = (len(zmq_clients) >= max(jobs, 1)
+                            and len(zmq_idle_clients) == len(zmq_clients))
+        if all_clients_idle or zmq_processes_killed == len(zmq_clients):
             if zmq_processes_killed < 0:
                 zmq_send_to_all_process(zmq_idle_clients, zmq_skt, [pickle.dumps(b'shutdown')])
                 zmq_processes_killed = 0
@@ -661,7 +1102,16 @@ def convert(files,
                               projection,
                               rotation_matrix,
                               rgb)
+                if compression_benchmark:
+                    print('{:^8}|{:^8}|{:^16}|{:^16}'.format('Codec', 'Ratio', 'Compress MB/s', 'Decompress MB/s'))
+                    for name, ratio, compress_speed, decompress_speed in codec.benchmark(node_store.codec.samples):
+                        print('{:^8}|{:^8}|{:^16}|{:^16}'.format(
+                            name, round(ratio, 2), round(compress_speed, 1), round(decompress_speed, 1)))
+
+                node_store.close()
                 shutil.rmtree(working_dir)
+                if staging_dir is not None:
+                    shutil.rmtree(staging_dir)
                 if verbose >= 1:
                     print('Done')
 
@@ -677,6 +1127,14 @@ def convert(files,
                 break
 
         if at_least_one_job_ended:
+            # read in advance the nodes that will be sent next (see the dispatch order above)
+            node_store.prefetch(itertools.chain(
+                reversed(state.to_pnts.input),
+                heapq.nsmallest(
+                    PREFETCH_COUNT,
+                    (k for k in state.node_process.input if k not in state.node_process.active),
+                    key=len)))
+
             if verbose >= 3:
                 print('{:^16}|{:^8}|{:^8}'.format('Name', 'Points', 'Seconds'))
                 for name, v in state.node_process.active.items():
@@ -699,7 +1157,7 @@ def convert(files,
                 print('{} % points in {} sec [{} tasks, {} nodes, {} wip]'.format(
                     round(100 * processed_points / infos['point_count'], 2),
                     round(now, 1),
-                    jobs - len(zmq_idle_clients),
+                    len(zmq_clients) - len(zmq_idle_clients),
                     len(state.node_process.active),
                     points_in_progress))
             elif verbose >= 0:
@@ -714,7 +1172,10 @@ def convert(files,
                 percent = round(100 * processed_points / infos['point_count'], 3)
                 print('{}, {}'.format(time.time() - startup, percent), file=progression_log)
 
-        node_store.control_memory_usage(cache_size, verbose)
+        # the pending batches share the cache budget, and are spilled when spilling nodes isn't enough
+        bytes_to_free = node_store.control_memory_usage(cache_size, verbose, state.pending_task_bytes)
+        if bytes_to_free > 0:
+            spill_tasks(state, node_store, bytes_to_free)
 
     if verbose >= 1:
         print('destroy', round(time_waiting_an_idle_process, 2))
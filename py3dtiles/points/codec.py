@@ -0,0 +1,143 @@
+import time
+import lz4.frame
+
+CODECS = ('none', 'lz4', 'lz4hc', 'zstd')
+
+# the compressed payloads start with the codec used, so that the workers
+# can decompress them without knowing the conversion settings
+_NONE = b'\x00'
+_LZ4 = b'\x01'
+_ZSTD = b'\x02'
+
+ZSTD_LEVEL = 3
+DICTIONARY_SIZE = 112 * 1024
+# size of the first payloads kept to train the zstd dictionary (and for benchmark)
+SAMPLES_SIZE = 4 * 1024 * 1024
+
+# dict_id -> zstandard.ZstdCompressionDict, see add_dictionary
+_dictionaries = {}
+_decompressors = {}
+
+
+class Codec:
+    """Compresses the nodes stored by the main process
+
+    - none: faster when the disk is fast and the memory plentiful
+    - lz4, lz4hc: fast compression, lz4hc compresses better but slower
+    - zstd: better ratio, with a dictionary trained on the first nodes.
+      Workers have to receive this dictionary (see add_dictionary) before
+      decompressing the nodes compressed with it.
+
+    With keep_samples, the first payloads are kept in samples (see benchmark).
+    """
+
+    def __init__(self, name, sample_size=SAMPLES_SIZE, keep_samples=False):
+        if name not in CODECS:
+            raise ValueError('Unknown codec {}, should be one of {}'.format(name, ', '.join(CODECS)))
+        self.name = name
+        self.sample_size = sample_size
+        self.keep_samples = keep_samples
+        self.samples = []
+        self.sampled_bytes = 0
+        # bytes of the trained zstd dictionary
+        self.dictionary = None
+        self.compressor = None
+        if name == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+    def train_dictionary(self, samples):
+        import zstandard
+        try:
+            dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+        except zstandard.ZstdError:
+            # not enough samples, keep compressing without dictionary
+            return
+        self.dictionary = dictionary.as_bytes()
+        add_dictionary(self.dictionary)
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+
+    def compress(self, data):
+        if (self.keep_samples or self.name == 'zstd') and self.sampled_bytes < self.sample_size:
+            self.samples.append(bytes(data))
+            self.sampled_bytes += len(data)
+            if self.name == 'zstd' and self.sampled_bytes >= self.sample_size:
+                self.train_dictionary(self.samples)
+                if not self.keep_samples:
+                    self.samples = []
+
+        if self.name == 'none':
+            return _NONE + data
+        elif self.name == 'lz4':
+            return _LZ4 + lz4.frame.compress(data)
+        elif self.name == 'lz4hc':
+            return _LZ4 + lz4.frame.compress(data, compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC)
+        return _ZSTD + self.compressor.compress(data)
+
+
+def add_dictionary(dictionary):
+    """Registers a zstd dictionary, returns its id"""
+    import zstandard
+    dictionary = zstandard.ZstdCompressionDict(dictionary)
+    _dictionaries[dictionary.dict_id()] = dictionary
+    return dictionary.dict_id()
+
+
+def decompress(data):
+    """Decompresses a payload compressed by any Codec"""
+    codec = data[:1]
+    payload = memoryview(data)[1:]
+    if codec == _LZ4:
+        return lz4.frame.decompress(payload)
+    elif codec == _NONE:
+        return payload.tobytes()
+    elif codec == _ZSTD:
+        import zstandard
+        dict_id = zstandard.get_frame_parameters(payload).dict_id
+        decompressor = _decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id == 0:
+                decompressor = zstandard.ZstdDecompressor()
+            elif dict_id in _dictionaries:
+                decompressor = zstandard.ZstdDecompressor(dict_data=_dictionaries[dict_id])
+            else:
+                raise Exception('Unknown zstd dictionary {}'.format(dict_id))
+            _decompressors[dict_id] = decompressor
+        return decompressor.decompress(payload)
+    raise Exception('Unknown codec {}'.format(codec))
+
+
+def benchmark(samples, codecs=CODECS):
+    """Compresses and decompresses samples with each codec
+
+    Returns a list of (codec, ratio, compression MB/s, decompression MB/s),
+    skipping the codecs whose module isn't installed.
+    The zstd dictionary is trained on the samples themselves, so its ratio
+    is a bit optimistic.
+    """
+    size = sum(len(s) for s in samples)
+    mb = size / (1024 * 1024)
+    results = []
+    for name in codecs:
+        try:
+            codec = Codec(name, sample_size=0)
+        except ImportError:
+            continue
+        if name == 'zstd':
+            codec.train_dictionary(samples)
+
+        start = time.perf_counter()
+        compressed = [codec.compress(s) for s in samples]
+        compression_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for c in compressed:
+            decompress(c)
+        decompression_time = time.perf_counter() - start
+
+        results.append((
+            name,
+            size / max(1, sum(len(c) for c in compressed)),
+            mb / max(compression_time, 1e-9),
+            mb / max(decompression_time, 1e-9)))
+    return results
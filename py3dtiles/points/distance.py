@@ -30,3 +30,25 @@ def xyz_to_key(xyz, cell_count, aabb_min, inv_aabb_size, shift):
     a[:, 1] <<= shift
     a[:, 2] <<= (2 * shift)
     return np.sum(a, axis=1).astype(np.int32)
+
+
+@njit(cache=True, nogil=True)
+def partition(keys, key_count):
+    """Stable counting sort of keys in [0, key_count)
+
+    Returns the order of the keys and the bounds of each key in it: the
+    indices of the keys equal to k are order[bounds[k]:bounds[k + 1]].
+    """
+    bounds = np.zeros(key_count + 1, dtype=np.int64)
+    for i in range(len(keys)):
+        bounds[keys[i] + 1] += 1
+    for k in range(key_count):
+        bounds[k + 1] += bounds[k]
+
+    positions = bounds[:-1].copy()
+    order = np.empty(len(keys), dtype=np.int64)
+    for i in range(len(keys)):
+        k = keys[i]
+        order[positions[k]] = i
+        positions[k] += 1
+    return order, bounds
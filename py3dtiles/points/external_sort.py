@@ -0,0 +1,297 @@
+import os
+import concurrent.futures
+import numpy as np
+from pickle import loads as ploads
+
+from py3dtiles.points.node import Node
+from py3dtiles.points.utils import MORTON_BITS, morton_codes, frames_to_points, split_aabb
+from py3dtiles.points.task.pnts_writer import points_to_pnts
+from py3dtiles.points.task.xyz_reader import OutsideAabbException
+
+# points of each sorted run written by the readers
+RUN_POINTS = 2000000
+# runs merged at once, more runs are merged in several passes
+MERGE_FAN_IN = 64
+# points read from each run at a time while merging
+MERGE_BLOCK_POINTS = 65536
+# a node with less points is a leaf (see Node.insert)
+LEAF_POINTS = 20000
+# bytes of a point in the runs: its code, xyz and rgb, stored as columns
+POINT_SIZE = 8 + 3 * 4 + 3
+
+
+def open_run(filename, count=None, mode='r'):
+    """Returns the (codes, xyz, rgb) columns of a run file, memory mapped"""
+    if count is None:
+        count = os.path.getsize(filename) // POINT_SIZE
+    if mode == 'w+':
+        with open(filename, 'wb') as f:
+            f.truncate(count * POINT_SIZE)
+        mode = 'r+'
+    codes = np.memmap(filename, dtype=np.uint64, mode=mode, shape=(count,))
+    xyz = np.memmap(filename, dtype=np.float32, mode=mode, offset=8 * count, shape=(count, 3))
+    rgb = np.memmap(filename, dtype=np.uint8, mode=mode, offset=20 * count, shape=(count, 3))
+    return codes, xyz, rgb
+
+
+class _RunWriter():
+    """Takes the place of the worker socket for the readers, and writes the points they send in sorted runs"""
+
+    def __init__(self, folder, prefix, aabb, run_points):
+        self.folder = folder
+        self.prefix = prefix
+        self.aabb = aabb
+        self.run_points = run_points
+        self.xyz = []
+        self.rgb = []
+        self.count = 0
+        # (filename, point count) of the written runs
+        self.runs = []
+        # some readers only know an estimation of their portion point count
+        self.point_count_delta = 0
+        # points that the readers found outside the aabb of the octree
+        self.outside_aabb = 0
+
+    def send_multipart(self, frames, copy=True, block=True):
+        if len(frames) == 1 and len(frames[0]) > 0:
+            # the status message at the end of the portion
+            status = ploads(frames[0])
+            self.point_count_delta += status.get('point_count_delta', 0)
+            self.outside_aabb += status.get('outside_aabb', 0)
+        elif len(frames) > 1 and len(frames[0]) == 0:
+            xyz, rgb = frames_to_points(frames[1:])
+            self.xyz.append(xyz)
+            self.rgb.append(rgb)
+            self.count += len(xyz)
+            if self.count >= self.run_points:
+                self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        xyz = np.concatenate(self.xyz)
+        rgb = np.concatenate(self.rgb)
+        codes = morton_codes(xyz, self.aabb)
+        order = np.argsort(codes, kind='stable')
+
+        filename = os.path.join(self.folder, '{}-{}.run'.format(self.prefix, len(self.runs)))
+        with open(filename, 'wb') as f:
+            f.write(codes[order].tobytes())
+            f.write(xyz[order].tobytes())
+            f.write(rgb[order].tobytes())
+        self.runs.append((filename, len(codes)))
+
+        self.xyz = []
+        self.rgb = []
+        self.count = 0
+
+
+def write_runs(reader_run, filename, offset_scale, portion, projection, folder, prefix, aabb, run_points=RUN_POINTS):
+    """Reads a portion of a file with reader_run
+
+    Returns the (filename, point count) of its sorted runs, and the
+    difference between the read point count and the estimated one.
+    Raises OutsideAabbException if the reader found points outside the aabb.
+    """
+    writer = _RunWriter(folder, prefix, aabb, run_points)
+    reader_run(prefix.encode('ascii'), filename, offset_scale, portion, writer, projection, 0)
+    if writer.outside_aabb > 0:
+        raise OutsideAabbException(
+            '{} points of {} are outside the aabb, use --aabb to give it'.format(writer.outside_aabb, filename))
+    writer.flush()
+    return writer.runs, writer.point_count_delta
+
+
+def merge_runs(runs, filename, block_points=MERGE_BLOCK_POINTS):
+    """Merges sorted runs in a new run, block by block, and removes them"""
+    count = sum(c for _, c in runs)
+    out_codes, out_xyz, out_rgb = open_run(filename, count, 'w+')
+    inputs = [open_run(f, c) for f, c in runs]
+    positions = [0] * len(inputs)
+
+    written = 0
+    while written < count:
+        blocks = [
+            (i, p, codes[p:p + block_points])
+            for i, ((codes, _, _), p) in enumerate(zip(inputs, positions)) if p < len(codes)]
+        # every point up to the smallest last code of the blocks is known
+        limits = [b[-1] for i, p, b in blocks if p + len(b) < len(inputs[i][0])]
+        limit = min(limits) if limits else None
+
+        codes, xyz, rgb = [], [], []
+        for i, p, block in blocks:
+            n = len(block) if limit is None else int(np.searchsorted(block, limit, side='right'))
+            codes.append(block[:n])
+            xyz.append(inputs[i][1][p:p + n])
+            rgb.append(inputs[i][2][p:p + n])
+            positions[i] += n
+
+        codes = np.concatenate(codes)
+        order = np.argsort(codes, kind='stable')
+        out_codes[written:written + len(codes)] = codes[order]
+        out_xyz[written:written + len(codes)] = np.concatenate(xyz)[order]
+        out_rgb[written:written + len(codes)] = np.concatenate(rgb)[order]
+        written += len(codes)
+
+    for column in (out_codes, out_xyz, out_rgb):
+        column.flush()
+    for f, _ in runs:
+        os.remove(f)
+    return filename, count
+
+
+def merge(executor, runs, folder, fan_in=MERGE_FAN_IN):
+    """Merges the runs in passes of fan_in runs at most, returns the (filename, point count) of the merged run"""
+    merge_pass = 0
+    while len(runs) > 1:
+        futures = [
+            executor.submit(
+                merge_runs, runs[i:i + fan_in],
+                os.path.join(folder, 'merge-{}-{}.run'.format(merge_pass, i)))
+            for i in range(0, len(runs), fan_in)]
+        runs = [f.result() for f in futures]
+        merge_pass += 1
+    return runs[0]
+
+
+def _is_leaf(count, spacing, depth, scale):
+    # same rule as Node.insert, and the codes can't split the nodes below MORTON_BITS
+    return count < LEAF_POINTS or spacing <= 0.001 * scale or depth >= MORTON_BITS
+
+
+def _children_bounds(codes, lo, hi, prefix, depth):
+    # the points of the children of a node are consecutive ranges of its points (see morton_codes)
+    shift = np.uint64(3 * (MORTON_BITS - depth - 1))
+    keys = (np.uint64(prefix * 8) + np.arange(9, dtype=np.uint64)) << shift
+    return lo + np.searchsorted(codes[lo:hi], keys)
+
+
+def _write_tile(name, xyz, rgb, out_folder, include_rgb):
+    points = xyz.view(np.uint8).ravel()
+    if include_rgb:
+        points = np.concatenate((points, rgb.ravel()))
+    return points_to_pnts(name, points, out_folder, include_rgb)[0]
+
+
+def _build(columns, name, aabb, spacing, lo, hi, prefix, scale, out_folder, include_rgb, subtrees):
+    """Writes the tiles of the descendants of name, bottom-up
+
+    Returns (xyz, rgb, has_children, written): the points of name, that its
+    parent will subsample before writing them, and the written point count.
+    """
+    if subtrees is not None and name in subtrees:
+        return subtrees[name]
+
+    codes, xyz, rgb = columns
+    depth = len(name)
+    if _is_leaf(hi - lo, spacing, depth, scale):
+        return np.array(xyz[lo:hi]), np.array(rgb[lo:hi]), False, 0
+
+    node = Node(name, aabb, spacing)
+    bounds = _children_bounds(codes, lo, hi, prefix, depth)
+    written = 0
+    for child in range(8):
+        if bounds[child] == bounds[child + 1]:
+            continue
+        child_name = name + str(child).encode('ascii')
+        child_xyz, child_rgb, has_children, child_written = _build(
+            columns, child_name, split_aabb(aabb, child), spacing * 0.5,
+            bounds[child], bounds[child + 1], prefix * 8 + child, scale, out_folder, include_rgb, subtrees)
+
+        # the node keeps the points of its children far enough from each other,
+        # but a child with children keeps one point so that its tile exists
+        kept = 1 if has_children else 0
+        remainder_xyz, remainder_rgb, needs_balance = node.grid.insert(
+            node.aabb[0], node.inv_aabb_size, child_xyz[kept:], child_rgb[kept:])
+        if needs_balance:
+            node.grid.balance(node.aabb_size, node.aabb[0], node.inv_aabb_size)
+
+        written += child_written + _write_tile(
+            child_name,
+            np.concatenate((child_xyz[:kept], remainder_xyz)),
+            np.concatenate((child_rgb[:kept], remainder_rgb)),
+            out_folder, include_rgb)
+
+    _, xyz, rgb = node.grid.to_arrays()
+    return xyz, rgb, True, written
+
+
+def build_subtree(filename, name, aabb, spacing, lo, hi, prefix, scale, out_folder, include_rgb):
+    """Writes the tiles of the descendants of name from the merged run, see _build"""
+    return _build(open_run(filename), name, aabb, spacing, lo, hi, prefix, scale, out_folder, include_rgb, None)
+
+
+def _subtrees(codes, name, aabb, spacing, lo, hi, prefix, scale, max_points):
+    """Yields the arguments of build_subtree for the subtrees of at most max_points points under name"""
+    depth = len(name)
+    if depth > 0 and (hi - lo <= max_points or _is_leaf(hi - lo, spacing, depth, scale)):
+        yield name, aabb, spacing, lo, hi, prefix
+        return
+
+    bounds = _children_bounds(codes, lo, hi, prefix, depth)
+    for child in range(8):
+        if bounds[child] < bounds[child + 1]:
+            yield from _subtrees(
+                codes, name + str(child).encode('ascii'), split_aabb(aabb, child), spacing * 0.5,
+                bounds[child], bounds[child + 1], prefix * 8 + child, scale, max_points)
+
+
+def run(portions, offset_scale, projection, octree_metadata, working_dir, out_folder, include_rgb, jobs, verbose=0):
+    """Converts the (reader run function, filename, portion) portions with bounded memory
+
+    Returns the written point count, and the difference between the read
+    point count and the estimated one (see write_runs).
+
+    1. the readers write the points in runs sorted by Morton code
+    2. the runs are merged in a single sorted run on disk
+    3. as the points of each node are consecutive in this run, the tiles are
+       written bottom-up: each node keeps the points of its children far
+       enough from each other (see Grid), the others are written in the
+       children tiles. The subtrees are built in parallel, then their
+       ancestors by the main process.
+
+    The root tile isn't written (see write_tileset).
+    """
+    aabb = octree_metadata.aabb
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            executor.submit(
+                write_runs, reader_run, filename, offset_scale, portion, projection, working_dir,
+                'run-{}'.format(i), aabb)
+            for i, (reader_run, filename, portion) in enumerate(portions)]
+        results = [f.result() for f in futures]
+        runs = [r for portion_runs, _ in results for r in portion_runs]
+        point_count_delta = sum(delta for _, delta in results)
+        read = sum(c for _, c in runs)
+        if verbose >= 1:
+            print('Sorted {} points in {} runs'.format(read, len(runs)))
+        if read == 0:
+            return 0, point_count_delta
+
+        filename, count = merge(executor, runs, working_dir)
+        if verbose >= 1:
+            print('Merged the runs')
+
+        columns = open_run(filename, count)
+        tasks = list(_subtrees(
+            columns[0], b'', aabb, octree_metadata.spacing, 0, count, 0, octree_metadata.scale,
+            max(LEAF_POINTS, count // (4 * max(1, jobs)))))
+        futures = {
+            task[0]: executor.submit(
+                build_subtree, filename, *task, octree_metadata.scale, out_folder, include_rgb)
+            for task in tasks}
+        subtrees = {name: f.result() for name, f in futures.items()}
+
+    # the top of the tree, from the roots of the subtrees
+    written = 0
+    bounds = _children_bounds(columns[0], 0, count, 0, 0)
+    for child in range(8):
+        if bounds[child] == bounds[child + 1]:
+            continue
+        name = str(child).encode('ascii')
+        xyz, rgb, _, child_written = _build(
+            columns, name, split_aabb(aabb, child), octree_metadata.spacing * 0.5,
+            bounds[child], bounds[child + 1], child, octree_metadata.scale, out_folder, include_rgb, subtrees)
+        written += child_written + _write_tile(name, xyz, rgb, out_folder, include_rgb)
+
+    return written, point_count_delta
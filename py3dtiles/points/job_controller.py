@@ -0,0 +1,101 @@
+import time
+import psutil
+
+# the node jobs are sized to take about this long
+NODE_JOB_DURATION = 0.5
+MIN_NODE_JOB_POINTS = 10000
+MAX_NODE_JOB_POINTS = 2000000
+# until the throughput of the workers is known
+DEFAULT_NODE_JOB_POINTS = 100000
+
+MIN_PORTION_POINTS = 100000
+MAX_PORTION_POINTS = 5000000
+
+# memory used by a point in progress (batches, nodes and their copies in the main process and the workers)
+BYTES_PER_POINT = 64
+# share of the available memory that can be used by the points in progress
+MEMORY_FRACTION = 0.5
+
+UPDATE_INTERVAL = 1.0
+
+
+class JobController():
+    """Sizes the node jobs and admits the reader portions, from what's measured during the conversion
+
+    - the node jobs are sized from the measured throughput of the workers,
+      and shared between the idle workers when there's little work left
+    - the readers are added while workers are idle, and removed while the
+      node jobs pile up
+    - the reader portions are only admitted if the points fit in the
+      available memory
+    """
+
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.max_readers = max(1, self.jobs // 2)
+        self.points_per_second = None
+
+        self.last_update = time.time()
+        self.idle_time = 0
+        self.worker_time = 0
+        self.memory_headroom = 0
+        self._update_memory_headroom()
+
+    def _update_memory_headroom(self):
+        self.memory_headroom = int(psutil.virtual_memory().available * MEMORY_FRACTION / BYTES_PER_POINT)
+
+    def portion_size(self):
+        """Returns the point count of the reader portions, a multiple of 100000"""
+        size = self.memory_headroom / (4 * self.jobs)
+        size = min(MAX_PORTION_POINTS, max(MIN_PORTION_POINTS, size))
+        return int(size / 100000) * 100000
+
+    def node_job_done(self, point_count, duration):
+        """Records the time a worker took to process point_count points"""
+        rate = point_count / max(duration, 0.001)
+        if self.points_per_second is None:
+            self.points_per_second = rate
+        else:
+            self.points_per_second = 0.9 * self.points_per_second + 0.1 * rate
+
+    def node_job_size(self, pending_points, idle_workers):
+        """Returns the point count to put in the next node job"""
+        if self.points_per_second is None:
+            size = DEFAULT_NODE_JOB_POINTS
+        else:
+            size = self.points_per_second * NODE_JOB_DURATION
+        # keep every idle worker busy
+        size = min(size, pending_points / max(1, idle_workers))
+        return int(min(MAX_NODE_JOB_POINTS, max(MIN_NODE_JOB_POINTS, size)))
+
+    def can_admit_portion(self, point_count, active_readers):
+        # always keep one reader running, so the conversion progresses
+        if active_readers == 0:
+            return True
+        return active_readers < self.max_readers and point_count <= self.memory_headroom
+
+    def portion_admitted(self, point_count):
+        self.memory_headroom -= point_count
+
+    def measure(self, worker_count, idle_workers):
+        """Accumulates the workers idle time, returns True when an update is due"""
+        now = time.time()
+        elapsed = now - self.last_update
+        self.idle_time += idle_workers * elapsed
+        self.worker_time += worker_count * elapsed
+        self.last_update = now
+
+        return self.worker_time >= UPDATE_INTERVAL * max(1, worker_count)
+
+    def update(self, worker_count, pending_node_points, pending_portions):
+        """Adapts the readers count, from the workers idle time since the last update"""
+        idle_ratio = self.idle_time / self.worker_time
+        job_size = self.node_job_size(pending_node_points, 1)
+        if idle_ratio > 0.1 and pending_portions and self.max_readers < worker_count:
+            self.max_readers += 1
+        elif pending_node_points > 4 * job_size * worker_count and self.max_readers > 1:
+            self.max_readers -= 1
+
+        self.idle_time = 0
+        self.worker_time = 0
+        self._update_memory_headroom()
@@ -1,13 +1,13 @@
 import numpy as np
-from pickle import dumps as pdumps, loads as ploads
 import os
 import json
 
 from py3dtiles import TileContentReader
 from py3dtiles.feature_table import SemanticPoint
-from py3dtiles.points.utils import name_to_filename, node_from_name, SubdivisionType, aabb_size_to_subdivision_type
+from py3dtiles.points.utils import name_to_filename, node_from_name, SubdivisionType, aabb_size_to_subdivision_type, points_to_frames
+from py3dtiles.points.utils import NodeColumns, node_columns_to_bytes, bytes_to_node_columns
 from py3dtiles.points.points_grid import Grid
-from py3dtiles.points.distance import xyz_to_child_index
+from py3dtiles.points.distance import xyz_to_child_index, partition
 from py3dtiles.points.task.pnts_writer import points_to_pnts
 
 
@@ -39,23 +39,27 @@ class Node(object):
         self.dirty = False
 
     def save_to_bytes(self):
-        sub_pickle = {}
+        """Serializes the node as columns (see NODE_HEADER), without pickling its arrays"""
         if self.children is not None:
-            sub_pickle['children'] = self.children
-            sub_pickle['grid'] = self.grid
+            children = b''.join(name[-1:] for name in self.children)
+            offsets, xyz, rgb = self.grid.to_arrays()
         else:
-            sub_pickle['points'] = self.points
+            children = b''
+            offsets = np.zeros(0, dtype=np.uint32)
+            xyz = np.concatenate([xyz for xyz, rgb in self.points] + [np.zeros((0, 3), dtype=np.float32)])
+            rgb = np.concatenate([rgb for xyz, rgb in self.points] + [np.zeros((0, 3), dtype=np.uint8)])
 
-        d = pdumps(sub_pickle)
-        return d
+        return node_columns_to_bytes(NodeColumns(
+            self.children is not None, self.grid.cell_count, children, offsets, xyz, rgb))
 
     def load_from_bytes(self, byt):
-        sub_pickle = ploads(byt)
-        if 'children' in sub_pickle:
-            self.children = sub_pickle['children']
-            self.grid = sub_pickle['grid']
+        # a single writable copy of the node, the grid cells are views of it
+        columns = bytes_to_node_columns(bytearray(byt))
+        if columns.has_grid:
+            self.children = [self.name + columns.children[i:i + 1] for i in range(len(columns.children))]
+            self.grid.load_arrays(columns.cell_count, columns.offsets, columns.xyz, columns.rgb)
         else:
-            self.points = sub_pickle['points']
+            self.points = [(columns.xyz, columns.rgb)]
 
     def insert(self, node_catalog, scale, xyz, rgb, make_empty_node=False):
         if make_empty_node:
@@ -100,9 +104,16 @@ class Node(object):
         self.pending_xyz = []
         self.pending_rgb = []
 
-    def dump_pending_points(self):
+    def take_pending_points(self):
+        """Returns the pending points as (child name, xyz, rgb), and forgets them"""
+        result = list(self._get_pending_points())
+        self.pending_xyz = []
+        self.pending_rgb = []
+        return result
+
+    def dump_pending_points(self, staging_dir=None):
         result = [
-            (name, pdumps({'xyz': xyz, 'rgb': rgb}), len(xyz))
+            (name, points_to_frames(xyz, rgb, staging_dir), len(xyz))
             for name, xyz, rgb in self._get_pending_points()
         ]
 
@@ -130,11 +141,17 @@ class Node(object):
         else:
             indices = xyz_to_child_index(pending_xyz_arr, self.aabb_center)
 
-        # unique children list
-        childs = np.unique(indices)
+        order, bounds = partition(indices, 8)
+        # points sorted by Morton code (see morton_sort) are already grouped by child
+        if np.any(order != np.arange(len(order))):
+            pending_xyz_arr = pending_xyz_arr[order]
+            pending_rgb_arr = pending_rgb_arr[order]
+
+        for child in range(8):
+            if bounds[child] == bounds[child + 1]:
+                continue
 
-        # make sure all children nodes exist
-        for child in childs:
+            # make sure all children nodes exist
             name = '{}{}'.format(self.name.decode('ascii'), child).encode('ascii')
             # create missing nodes, only for remembering they exist.
             # We don't want to serialize them
@@ -144,10 +161,9 @@ class Node(object):
                 self.dirty = True
                 # print('Added node {}'.format(name))
 
-            mask = np.where(indices - child == 0)
-            xyz = pending_xyz_arr[mask]
-            if len(xyz) > 0:
-                yield name, xyz, pending_rgb_arr[mask]
+            yield (name,
+                   pending_xyz_arr[bounds[child]:bounds[child + 1]],
+                   pending_rgb_arr[bounds[child]:bounds[child + 1]])
 
     def _split(self, node_catalog, scale):
         self.children = []
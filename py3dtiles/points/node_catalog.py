@@ -1,6 +1,6 @@
 import math
 from pickle import dumps as pdumps, loads as ploads
-import lz4.frame as gzip
+from py3dtiles.points import codec
 from py3dtiles.points.utils import split_aabb
 from py3dtiles.points.node import Node
 
@@ -38,6 +38,8 @@ class NodeCatalog:
         node = self.nodes[name]
         if node.dirty:
             self.node_bytes[name] = node.save_to_bytes()
+            # the catalog may be reused by the next job on this node
+            node.dirty = False
 
         if node.children is not None and max_depth > 0:
             for n in node.children:
@@ -47,7 +49,7 @@ class NodeCatalog:
 
     def _load_from_store(self, name, data):
         if len(data) > 0:
-            out = ploads(gzip.decompress(data))
+            out = ploads(codec.decompress(data))
             for n in out:
                 spacing = self.root_spacing / math.pow(2, len(n))
                 aabb = self.root_aabb
@@ -2,57 +2,264 @@ import numpy as np
 from numba import njit
 
 from py3dtiles.points.utils import SubdivisionType, aabb_size_to_subdivision_type
-from py3dtiles.points.distance import is_point_far_enough, xyz_to_key
+from py3dtiles.points.distance import xyz_to_key, partition
 
+# capacity of a cell when its first point is inserted, doubled each time it's full
+MIN_CELL_CAPACITY = 16
 
-@njit(fastmath=True, cache=True)
-def _insert(cells_xyz, cells_rgb, aabmin, inv_aabb_size, cell_count, xyz, rgb, spacing, shift, force=False):
+# the points of each cell are also indexed by spacing sized voxels, so that a
+# new point is only compared to the points of the 27 voxels around it: this
+# is the initial size of the hash table of the voxels
+MIN_VOXEL_TABLE_SIZE = 64
+NO_POINT = -1
+# the voxels are slightly bigger than the spacing, so that floating point
+# errors can't put 2 close points in non adjacent voxels
+VOXEL_MARGIN = 1.001
+
+
+@njit(cache=True, nogil=True)
+def _reserve(xyz, rgb, next_points, starts, counts, capacities, used, k, capacity):
+    """Moves the points of cell k at the end of the used part of xyz and rgb, with the given capacity
+
+    When there isn't enough room left, the arrays are reallocated and the
+    other cells compacted. Returns the (xyz, rgb, next_points, used) to use
+    from now on.
+    """
+    old_xyz = xyz
+    old_rgb = rgb
+    old_next_points = next_points
+    if used + capacity > xyz.shape[0]:
+        live = capacity
+        for c in range(len(counts)):
+            if c != k:
+                live += capacities[c]
+        xyz = np.empty((2 * live, 3), dtype=np.float32)
+        rgb = np.empty((2 * live, 3), dtype=np.uint8)
+        next_points = np.empty(2 * live, dtype=np.int32)
+        used = 0
+        for c in range(len(counts)):
+            if c == k or capacities[c] == 0:
+                continue
+            start = starts[c]
+            xyz[used:used + counts[c]] = old_xyz[start:start + counts[c]]
+            rgb[used:used + counts[c]] = old_rgb[start:start + counts[c]]
+            next_points[used:used + counts[c]] = old_next_points[start:start + counts[c]]
+            starts[c] = used
+            used += capacities[c]
+
+    start = starts[k]
+    xyz[used:used + counts[k]] = old_xyz[start:start + counts[k]]
+    rgb[used:used + counts[k]] = old_rgb[start:start + counts[k]]
+    next_points[used:used + counts[k]] = old_next_points[start:start + counts[k]]
+    starts[k] = used
+    capacities[k] = capacity
+    return xyz, rgb, next_points, used + capacity
+
+
+@njit(cache=True, nogil=True)
+def _voxel_key(k, vx, vy, vz):
+    # the cell index (< 2^13) and the voxel coordinates (16 bits each)
+    key = np.int64(k)
+    for v in (vx, vy, vz):
+        key = (key << 16) | min(max(v + 32768, 0), 65535)
+    return key
+
+
+@njit(cache=True, nogil=True)
+def _voxel_slot(voxel_keys, key):
+    """Returns the slot of key in the hash table, or the empty slot where it should be added"""
+    mask = len(voxel_keys) - 1
+    h = key * 0x5851F42D4C957F2D
+    slot = (h ^ (h >> 29)) & mask
+    while voxel_keys[slot] != NO_POINT and voxel_keys[slot] != key:
+        slot = (slot + 1) & mask
+    return slot
+
+
+@njit(cache=True, nogil=True)
+def _add_to_voxel(voxel_keys, voxel_heads, voxel_count, next_points, start, point, key):
+    """Adds the point-th point of a cell to its voxel, returns the (voxel_keys, voxel_heads, voxel_count)"""
+    slot = _voxel_slot(voxel_keys, key)
+    if voxel_keys[slot] == NO_POINT:
+        voxel_keys[slot] = key
+        voxel_heads[slot] = NO_POINT
+        voxel_count += 1
+    # the points of a voxel are linked by their index in the cell
+    next_points[start + point] = voxel_heads[slot]
+    voxel_heads[slot] = point
+
+    if 2 * voxel_count > len(voxel_keys):
+        old_keys = voxel_keys
+        old_heads = voxel_heads
+        voxel_keys = np.full(2 * len(old_keys), NO_POINT, dtype=np.int64)
+        voxel_heads = np.empty(2 * len(old_keys), dtype=np.int32)
+        for i in range(len(old_keys)):
+            if old_keys[i] != NO_POINT:
+                new_slot = _voxel_slot(voxel_keys, old_keys[i])
+                voxel_keys[new_slot] = old_keys[i]
+                voxel_heads[new_slot] = old_heads[i]
+    return voxel_keys, voxel_heads, voxel_count
+
+
+@njit(fastmath=True, cache=True, nogil=True)
+def _is_far_enough(cells_xyz, next_points, start, voxel_keys, voxel_heads, k, voxel, point, squared_min_distance):
+    """Whether point is far enough from the points of cell k, found in the voxels around it"""
+    for dx in range(-1, 2):
+        for dy in range(-1, 2):
+            for dz in range(-1, 2):
+                key = _voxel_key(k, voxel[0] + dx, voxel[1] + dy, voxel[2] + dz)
+                slot = _voxel_slot(voxel_keys, key)
+                if voxel_keys[slot] == NO_POINT:
+                    continue
+                i = voxel_heads[slot]
+                while i != NO_POINT:
+                    other = cells_xyz[start + i]
+                    if (point[0] - other[0]) ** 2 + \
+                       (point[1] - other[1]) ** 2 + \
+                       (point[2] - other[2]) ** 2 < squared_min_distance:
+                        return False
+                    i = next_points[start + i]
+    return True
+
+
+@njit(fastmath=True, cache=True, nogil=True)
+def _insert(cells_xyz, cells_rgb, next_points, starts, counts, capacities, used,
+            voxel_keys, voxel_heads, voxel_count, origin, inv_voxel_size,
+            aabmin, inv_aabb_size, cell_count, xyz, rgb, spacing, shift, force=False):
+    """Inserts the points cell by cell, returns the updated arrays and the mask of the points not inserted
+
+    The points are only compared to the points of their cell inserted before
+    them, so partitioning them by cell (stable counting sort) gives the same
+    result as inserting them one by one, while each cell is grown at most once.
+    """
     keys = xyz_to_key(xyz, cell_count, aabmin, inv_aabb_size, shift)
+    order, bounds = partition(keys, len(counts))
+    voxels = np.floor((xyz - origin) * inv_voxel_size).astype(np.int64)
+    squared_min_distance = np.float32(spacing)
+
+    notinserted = np.full(len(xyz), False)
+    needs_balance = False
 
-    if force:
-        # allocate this one once and for all
-        for k in np.unique(keys):
-            idx = np.where(keys - k == 0)
-            cells_xyz[k] = np.concatenate((cells_xyz[k], xyz[idx]))
-            cells_rgb[k] = np.concatenate((cells_rgb[k], rgb[idx]))
-    else:
-        notinserted = np.full(len(xyz), False)
-        needs_balance = False
-
-        for i in range(len(xyz)):
-            k = keys[i]
-            if cells_xyz[k].shape[0] == 0 or is_point_far_enough(cells_xyz[k], xyz[i], spacing):
-                cells_xyz[k] = np.concatenate((cells_xyz[k], xyz[i].reshape(1, 3)))
-                cells_rgb[k] = np.concatenate((cells_rgb[k], rgb[i].reshape(1, 3)))
-                if cell_count[0] < 8:
-                    needs_balance = needs_balance or cells_xyz[k].shape[0] > 200000
+    for k in range(len(counts)):
+        begin = bounds[k]
+        end = bounds[k + 1]
+        if begin == end:
+            continue
+
+        for j in range(begin, end):
+            i = order[j]
+            count = counts[k]
+            if force or count == 0 or _is_far_enough(
+                    cells_xyz, next_points, starts[k], voxel_keys, voxel_heads, k, voxels[i], xyz[i],
+                    squared_min_distance):
+                if count == capacities[k]:
+                    # room for all the remaining points of the cell
+                    cells_xyz, cells_rgb, next_points, used = _reserve(
+                        cells_xyz, cells_rgb, next_points, starts, counts, capacities, used, k,
+                        max(MIN_CELL_CAPACITY, 2 * count, count + end - j))
+                cells_xyz[starts[k] + count] = xyz[i]
+                cells_rgb[starts[k] + count] = rgb[i]
+                voxel_keys, voxel_heads, voxel_count = _add_to_voxel(
+                    voxel_keys, voxel_heads, voxel_count, next_points, starts[k], count,
+                    _voxel_key(k, voxels[i][0], voxels[i][1], voxels[i][2]))
+                counts[k] = count + 1
             else:
                 notinserted[i] = True
 
-        return xyz[notinserted], rgb[notinserted], needs_balance
+        if not force and cell_count[0] < 8:
+            needs_balance = needs_balance or counts[k] > 200000
+
+    return cells_xyz, cells_rgb, next_points, used, voxel_keys, voxel_heads, voxel_count, notinserted, needs_balance
+
+
+@njit(cache=True, nogil=True)
+def _index(cells_xyz, next_points, starts, counts, voxel_keys, voxel_heads, origin, inv_voxel_size):
+    """Indexes the points of all the cells in their voxels, returns the (voxel_keys, voxel_heads, voxel_count)"""
+    voxel_count = 0
+    for k in range(len(counts)):
+        for point in range(counts[k]):
+            p = cells_xyz[starts[k] + point]
+            key = _voxel_key(
+                k,
+                int(np.floor((p[0] - origin[0]) * inv_voxel_size)),
+                int(np.floor((p[1] - origin[1]) * inv_voxel_size)),
+                int(np.floor((p[2] - origin[2]) * inv_voxel_size)))
+            voxel_keys, voxel_heads, voxel_count = _add_to_voxel(
+                voxel_keys, voxel_heads, voxel_count, next_points, starts[k], point, key)
+    return voxel_keys, voxel_heads, voxel_count
+
+
+@njit(cache=True, nogil=True)
+def _gather(cells_xyz, cells_rgb, starts, counts):
+    total = 0
+    for k in range(len(counts)):
+        total += counts[k]
+    xyz = np.empty((total, 3), dtype=np.float32)
+    rgb = np.empty((total, 3), dtype=np.uint8)
+    position = 0
+    for k in range(len(counts)):
+        start = starts[k]
+        xyz[position:position + counts[k]] = cells_xyz[start:start + counts[k]]
+        rgb[position:position + counts[k]] = cells_rgb[start:start + counts[k]]
+        position += counts[k]
+    return xyz, rgb
 
 
 class Grid(object):
-    """docstring for Grid"""
+    """Points of a node, spread in cells so that they're far enough from each other
+
+    The points of all the cells are stored in the same xyz and rgb arrays:
+    each cell owns the capacities[k] points from starts[k], of which
+    counts[k] are used. A full cell is moved at the end of the arrays with
+    twice its capacity (see _reserve), so the points are appended in place.
 
-    __slots__ = ('cell_count', 'cells_xyz', 'cells_rgb', 'spacing')
+    The points of a cell are linked by voxel (next_points), and the first
+    point of each voxel is found with a hash table (voxel_keys, voxel_heads).
+    """
+
+    __slots__ = (
+        'cell_count', 'cells_xyz', 'cells_rgb', 'starts', 'counts', 'capacities', 'used', 'spacing',
+        'next_points', 'voxel_keys', 'voxel_heads', 'voxel_count', 'origin', 'inv_voxel_size')
 
     def __init__(self, node, initial_count=3):
         super(Grid, self).__init__()
         self.cell_count = np.array([initial_count, initial_count, initial_count], dtype=np.int32)
         self.spacing = node.spacing * node.spacing
+        self.origin = node.aabb[0].astype(np.float32)
+        self.inv_voxel_size = 1.0 / (node.spacing * VOXEL_MARGIN)
+        self._clear()
 
-        self.cells_xyz = [np.zeros((0, 3), dtype=np.float32) for _ in range(self.max_key_value)]
-        self.cells_rgb = [np.zeros((0, 3), dtype=np.uint8) for _ in range(self.max_key_value)]
+    def _clear(self):
+        self.cells_xyz = np.zeros((0, 3), dtype=np.float32)
+        self.cells_rgb = np.zeros((0, 3), dtype=np.uint8)
+        self.next_points = np.zeros(0, dtype=np.int32)
+        self.starts = np.zeros(self.max_key_value, dtype=np.int64)
+        self.counts = np.zeros(self.max_key_value, dtype=np.int64)
+        self.capacities = np.zeros(self.max_key_value, dtype=np.int64)
+        self.used = 0
+        self.voxel_keys = np.full(MIN_VOXEL_TABLE_SIZE, NO_POINT, dtype=np.int64)
+        self.voxel_heads = np.empty(MIN_VOXEL_TABLE_SIZE, dtype=np.int32)
+        self.voxel_count = 0
 
     @property
     def max_key_value(self):
         return 1 << (2 * int(self.cell_count[0]).bit_length() + int(self.cell_count[2]).bit_length())
 
     def insert(self, aabmin, inv_aabb_size, xyz, rgb, force=False):
-        return _insert(
+        (self.cells_xyz, self.cells_rgb, self.next_points, self.used,
+         self.voxel_keys, self.voxel_heads, self.voxel_count, notinserted, needs_balance) = _insert(
             self.cells_xyz,
             self.cells_rgb,
+            self.next_points,
+            self.starts,
+            self.counts,
+            self.capacities,
+            self.used,
+            self.voxel_keys,
+            self.voxel_heads,
+            self.voxel_count,
+            self.origin,
+            self.inv_voxel_size,
             aabmin,
             inv_aabb_size,
             self.cell_count,
@@ -60,13 +267,10 @@ class Grid(object):
             rgb,
             self.spacing,
             int(self.cell_count[0] - 1).bit_length(), force)
+        return xyz[notinserted], rgb[notinserted], needs_balance
 
     def needs_balance(self):
-        if self.cell_count[0] < 8:
-            for cell in self.cells_xyz:
-                if cell.shape[0] > 100000:
-                    return True
-        return False
+        return self.cell_count[0] < 8 and bool(np.any(self.counts > 100000))
 
     def balance(self, aabb_size, aabmin, inv_aabb_size):
         t = aabb_size_to_subdivision_type(aabb_size)
@@ -76,26 +280,42 @@ class Grid(object):
             self.cell_count[2] += 1
         assert self.cell_count[0] < 9
 
-        old_cells_xyz = self.cells_xyz
-        old_cells_rgb = self.cells_rgb
-        self.cells_xyz = [np.zeros((0, 3), dtype=np.float32) for _ in range(self.max_key_value)]
-        self.cells_rgb = [np.zeros((0, 3), dtype=np.uint8) for _ in range(self.max_key_value)]
+        _, xyz, rgb = self.to_arrays()
+        self._clear()
+        self.insert(aabmin, inv_aabb_size, xyz, rgb, True)
 
-        for cellxyz, cellrgb in zip(old_cells_xyz, old_cells_rgb):
-            self.insert(aabmin, inv_aabb_size, cellxyz, cellrgb, True)
+    def get_point_count(self):
+        return int(self.counts.sum())
 
-    def get_points(self, include_rgb):
-        xyz = ()
-        rgb = ()
-        pt = 0
-        for i in range(len(self.cells_xyz)):
-            xyz += ((self.cells_xyz[i]).view(np.uint8).ravel(),)
-            rgb += (self.cells_rgb[i].ravel(),)
-            pt += self.cells_xyz[i].shape[0]
+    def to_arrays(self):
+        """Returns the offsets of the cells in the points, and the points xyz and rgb in cells order"""
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.uint32)
+        offsets[1:] = np.cumsum(self.counts)
+        xyz, rgb = _gather(self.cells_xyz, self.cells_rgb, self.starts, self.counts)
+        return offsets, xyz, rgb
+
+    def load_arrays(self, cell_count, offsets, xyz, rgb):
+        """Restores the grid from to_arrays results, xyz and rgb are used in place until a cell is full"""
+        self.cell_count = np.array(cell_count, dtype=np.int32)
+        assert len(offsets) == self.max_key_value + 1
+        self.cells_xyz = xyz
+        self.cells_rgb = rgb
+        self.starts = offsets[:-1].astype(np.int64)
+        self.counts = np.diff(offsets).astype(np.int64)
+        self.capacities = self.counts.copy()
+        self.used = len(xyz)
+        self.next_points = np.empty(len(xyz), dtype=np.int32)
+        table_size = MIN_VOXEL_TABLE_SIZE
+        while table_size < 2 * len(xyz):
+            table_size *= 2
+        self.voxel_keys, self.voxel_heads, self.voxel_count = _index(
+            self.cells_xyz, self.next_points, self.starts, self.counts,
+            np.full(table_size, NO_POINT, dtype=np.int64), np.empty(table_size, dtype=np.int32),
+            self.origin, self.inv_voxel_size)
 
+    def get_points(self, include_rgb):
+        _, xyz, rgb = self.to_arrays()
         if include_rgb:
-            res = np.concatenate((np.concatenate(xyz), np.concatenate(rgb)))
-            assert len(res) == pt * (3 * 4 + 3)
-            return res
+            return np.concatenate((xyz.view(np.uint8).ravel(), rgb.ravel()))
         else:
-            return np.concatenate(xyz)
+            return xyz.view(np.uint8).ravel()
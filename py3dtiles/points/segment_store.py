@@ -0,0 +1,121 @@
+import os
+import threading
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+# segments with less live data than this are compacted
+COMPACTION_RATIO = 0.5
+
+
+class Segment:
+    __slots__ = ('filename', 'fd', 'size', 'live')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = 0
+        self.live = 0
+
+
+class SegmentStore:
+    """Append-only storage of the nodes spilled by SharedNodeStore
+
+    Nodes are appended to the current segment file, and an in-memory index
+    keeps their (segment, offset, size). Overwritten or removed nodes leave
+    dead bytes in their segment: segments are deleted once they only hold
+    dead bytes, and compacted (their live nodes appended to the current
+    segment) when mostly dead.
+
+    The methods can be called from several threads.
+    """
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        # name -> (segment id, offset, size)
+        self.index = {}
+        self.segments = {}
+        self.current = -1
+        self._new_segment()
+
+    def _new_segment(self):
+        previous = self.segments.get(self.current)
+        if previous is not None and previous.live == 0:
+            os.close(previous.fd)
+            os.remove(previous.filename)
+            del self.segments[self.current]
+        self.current += 1
+        self.segments[self.current] = Segment(
+            os.path.join(self.folder, 'segment-{}.bin'.format(self.current)))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _append(self, name, data):
+        segment = self.segments[self.current]
+        if segment.size > 0 and segment.size + len(data) > self.segment_size:
+            self._new_segment()
+            segment = self.segments[self.current]
+        os.pwrite(segment.fd, data, segment.size)
+        self._forget(name)
+        self.index[name] = (self.current, segment.size, len(data))
+        segment.size += len(data)
+        segment.live += len(data)
+
+    def _forget(self, name):
+        entry = self.index.pop(name, None)
+        if entry is None:
+            return
+        segment = self.segments[entry[0]]
+        segment.live -= entry[2]
+        if segment.live == 0 and entry[0] != self.current:
+            os.close(segment.fd)
+            os.remove(segment.filename)
+            del self.segments[entry[0]]
+
+    def write(self, name, data):
+        with self.lock:
+            self._append(name, data)
+
+    def read(self, name):
+        """Returns the content of name, or None if it's not stored"""
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+            return os.pread(self.segments[entry[0]].fd, entry[2], entry[1])
+
+    def remove(self, name):
+        with self.lock:
+            self._forget(name)
+
+    def needs_compaction(self):
+        with self.lock:
+            return any(
+                s.live < COMPACTION_RATIO * s.size
+                for i, s in self.segments.items() if i != self.current)
+
+    def compact(self):
+        """Moves the live nodes of the mostly dead segments to the current one"""
+        with self.lock:
+            candidates = [
+                i for i, s in self.segments.items()
+                if i != self.current and s.live < COMPACTION_RATIO * s.size]
+            names = [(n, e[0]) for n, e in self.index.items() if e[0] in candidates]
+
+        # node by node, to not block the other threads for too long
+        for name, segment_id in names:
+            with self.lock:
+                entry = self.index.get(name)
+                # the node may have been removed or rewritten meanwhile
+                if entry is not None and entry[0] == segment_id:
+                    data = os.pread(self.segments[segment_id].fd, entry[2], entry[1])
+                    self._append(name, data)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                os.close(segment.fd)
+                os.remove(segment.filename)
+            self.segments = {}
+            self.index = {}
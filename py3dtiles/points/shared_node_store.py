@@ -1,89 +1,174 @@
-import os
 import time
-import gc
-import lz4.frame as gzip
+import itertools
+import concurrent.futures
+from py3dtiles.points.codec import Codec
 from sys import getsizeof
-from py3dtiles.points.utils import name_to_filename
+from py3dtiles.points.segment_store import SegmentStore
+
+
+# max count of nodes read in advance
+PREFETCH_COUNT = 32
 
 
 class SharedNodeStore:
-    def __init__(self, folder):
+    """Cache of the nodes state, spilled on disk when it gets too big
+
+    Spilled nodes are appended to the segment files of a SegmentStore.
+    Disk reads and writes are done by a pool of threads, so that the main
+    process loop doesn't wait for them: spilled nodes stay available until
+    they're written, and the nodes about to be used can be read in advance
+    (see prefetch).
+
+    The memory usage accounts for the cached nodes, the ones being written
+    and read, and the points batches spilled by the caller (see put_batch).
+    """
+
+    def __init__(self, folder, io_threads=4, codec=None):
+        # name -> (last access time, index in self.data)
         self.metadata = {}
         self.data = []
+        # indices of the unused self.data entries
+        self.free_slots = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=io_threads)
+        # name -> (future, data) of the nodes being written on disk
+        self.writing = {}
+        # name -> future of the nodes being read from disk
+        self.prefetched = {}
         self.folder = folder
+        self.disk = SegmentStore(folder)
+        self.compacting = None
+        self.batch_ids = itertools.count()
+        self.codec = Codec('lz4') if codec is None else codec
         self.stats = {
             'hit': 0,
             'miss': 0,
             'new': 0,
+            'prefetch': 0,
         }
         self.memory_size = {
             'content': 0,
             'container': getsizeof(self.data) + getsizeof(self.metadata),
+            # data of self.writing
+            'writing': 0,
         }
 
-    def control_memory_usage(self, max_size_MB, verbose):
+    def memory_usage(self):
+        """Returns the bytes held by the store, including its pending disk reads and writes"""
+        prefetched = sum(
+            len(f.result() or b'') for f in self.prefetched.values() if f.done())
+        return sum(self.memory_size.values()) + prefetched
+
+    def control_memory_usage(self, max_size_MB, verbose, other_bytes=0):
+        """Spills nodes until the store and other_bytes fit in max_size_MB
+
+        other_bytes is the memory used by the caller for the conversion (its
+        pending points batches). Returns how many of these bytes should be
+        freed too, when spilling all the nodes isn't enough.
+        """
         bytes_to_mb = 1.0 / (1024 * 1024)
-        max_size_MB = max(max_size_MB, 200)
+        max_size = max(max_size_MB, 200) / bytes_to_mb
 
         if verbose >= 3:
             self.print_statistics()
 
-        # guess cache size
-        cache_size = (self.memory_size['container'] + self.memory_size['content']) * bytes_to_mb
+        # forget the nodes that are now on disk
+        for name in [n for n, w in self.writing.items() if w[0].done()]:
+            self._pop_writing(name)
+
+        if (self.compacting is None or self.compacting.done()) and self.disk.needs_compaction():
+            self.compacting = self.executor.submit(self.disk.compact)
 
-        before = cache_size
-        if before < max_size_MB:
-            return
+        before = self.memory_usage() + other_bytes
+        if before < max_size:
+            return 0
 
         if verbose >= 2:
-            print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> CACHE CLEANING [{}]'.format(before))
-        self.remove_oldest_nodes(1 - max_size_MB / before)
-        gc.collect()
+            print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> CACHE CLEANING [{}]'.format(before * bytes_to_mb))
+        # go a bit under the limit, to not spill on each call
+        to_free = before - 0.9 * max_size
+        cached = self.memory_size['container'] + self.memory_size['content']
+        _, freed = self.remove_oldest_nodes(min(1, to_free / cached))
 
         if verbose >= 2:
             print('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< CACHE CLEANING')
 
+        # the evicted nodes are freed as soon as they're written
+        return max(0, int(to_free - freed))
+
     def get(self, name, stat_inc=1):
         metadata = self.metadata.get(name, None)
         data = b''
         if metadata is not None:
             data = self.data[metadata[1]]
+            self.metadata[name] = (time.time(), metadata[1])
+            self.stats['hit'] += stat_inc
+        elif name in self.writing:
+            data = self.writing[name][1]
             self.stats['hit'] += stat_inc
         else:
-            filename = name_to_filename(self.folder, name)
-            if os.path.exists(filename):
-                self.stats['miss'] += stat_inc
-                with open(filename, 'rb') as f:
-                    data = f.read()
+            future = self.prefetched.pop(name, None)
+            if future is not None:
+                content = future.result()
+            else:
+                content = self.disk.read(name)
+            if content is not None:
+                data = content
+                self.stats['prefetch' if future is not None else 'miss'] += stat_inc
             else:
                 self.stats['new'] += stat_inc
             #  should we cache this node?
 
         return data
 
+    def prefetch(self, names):
+        """Starts reading from disk the nodes in names that aren't cached"""
+        for name in names:
+            if len(self.prefetched) >= PREFETCH_COUNT:
+                break
+            if name in self.metadata or name in self.writing or name in self.prefetched:
+                continue
+            self.prefetched[name] = self.executor.submit(self.disk.read, name)
+
+    def _pop_writing(self, name):
+        writing = self.writing.pop(name, None)
+        if writing is None:
+            return None
+        writing[0].result()
+        self.memory_size['writing'] -= len(writing[1])
+        return writing[1]
+
+    def _wait_io(self, name):
+        future = self.prefetched.pop(name, None)
+        if future is not None:
+            future.result()
+        self._pop_writing(name)
+
     def remove(self, name):
+        self._wait_io(name)
         meta = self.metadata.pop(name, None)
 
-        filename = name_to_filename(self.folder, name)
         if meta is None:
-            assert os.path.exists(filename), '{} should exist'.format(filename)
+            assert name in self.disk, '{} should exist'.format(name)
         else:
-            self.memory_size['content'] -= getsizeof(meta)
-            self.memory_size['content'] -= len(self.data[meta[1]])
-            self.memory_size['container'] = getsizeof(self.data) + getsizeof(self.metadata)
-            self.data[meta[1]] = None
+            self._free(name, meta)
 
-        if os.path.exists(filename):
-            os.remove(filename)
+        self.disk.remove(name)
 
     def put(self, name, data):
-        compressed_data = gzip.compress(data)
+        compressed_data = self.codec.compress(data)
+        # a prefetched content would be outdated
+        self.prefetched.pop(name, None)
 
         metadata = self.metadata.get(name, None)
         if metadata is None:
-            metadata = (time.time(), len(self.data))
-            self.data.append(compressed_data)
+            if self.free_slots:
+                metadata = (time.time(), self.free_slots.pop())
+                self.data[metadata[1]] = compressed_data
+            else:
+                metadata = (time.time(), len(self.data))
+                self.data.append(compressed_data)
         else:
+            self.memory_size['content'] -= len(self.data[metadata[1]]) + getsizeof((name, metadata))
             metadata = (time.time(), metadata[1])
             self.data[metadata[1]] = compressed_data
         self.metadata.update([(name, metadata)])
@@ -91,34 +176,71 @@ class SharedNodeStore:
         self.memory_size['content'] += len(compressed_data) + getsizeof((name, metadata))
         self.memory_size['container'] = getsizeof(self.data) + getsizeof(self.metadata)
 
-    def remove_oldest_nodes(self, percent):
-        count = _remove_all(self)
-
-        self.memory_size['content'] = 0
+    def _free(self, name, meta):
+        self.memory_size['content'] -= getsizeof((name, meta))
+        self.memory_size['content'] -= len(self.data[meta[1]])
         self.memory_size['container'] = getsizeof(self.data) + getsizeof(self.metadata)
+        self.data[meta[1]] = None
+        self.free_slots.append(meta[1])
 
-        assert(len(self.metadata) == 0)
-        assert(len(self.data) == 0)
-        return count
+    def remove_oldest_nodes(self, percent):
+        """Writes the least recently used nodes to disk, until percent of the cached bytes are freed"""
+        to_free = percent * (self.memory_size['container'] + self.memory_size['content'])
+        freed = 0
+        evicted = []
+        for name, meta in sorted(self.metadata.items(), key=lambda m: m[1][0]):
+            if freed >= to_free:
+                break
+            freed += len(self.data[meta[1]]) + getsizeof((name, meta))
+            evicted.append(name)
+
+        return _evict(self, evicted)
+
+    def put_batch(self, data):
+        """Spills a points batch on disk, returns the key to read it back (see take_batch)"""
+        key = 'batch-{}'.format(next(self.batch_ids)).encode('ascii')
+        self.writing[key] = (self.executor.submit(self.disk.write, key, data), data)
+        self.memory_size['writing'] += len(data)
+        return key
+
+    def take_batch(self, key):
+        """Returns a batch spilled by put_batch, and removes it from disk"""
+        writing = self.writing.get(key)
+        # no need to write it if the write hasn't started yet
+        if writing is not None and writing[0].cancel():
+            del self.writing[key]
+            self.memory_size['writing'] -= len(writing[1])
+            return writing[1]
+        data = self._pop_writing(key)
+        if data is None:
+            data = self.disk.read(key)
+        self.disk.remove(key)
+        return data
+
+    def close(self):
+        """Waits for the pending disk writes, and deletes the segment files"""
+        self.executor.shutdown(wait=True)
+        self.disk.close()
 
     def print_statistics(self):
-        print('Stats: Hits = {}, Miss = {}, New = {}'.format(
+        print('Stats: Hits = {}, Miss = {}, Prefetched = {}, New = {}'.format(
             self.stats['hit'],
             self.stats['miss'],
+            self.stats['prefetch'],
             self.stats['new']))
 
 
-def _remove_all(store):
-    # delete the entries
-    count = len(store.metadata)
+def _evict(store, names):
+    # write the entries on disk in the background, and remove them from the cache
     bytes_written = 0
-    for name, meta in store.metadata.items():
+    for name in names:
+        meta = store.metadata.pop(name)
         data = store.data[meta[1]]
-        filename = name_to_filename(store.folder, name)
-        with open(filename, 'wb') as f:
-            bytes_written += f.write(data)
-
-    store.metadata = {}
-    store.data = []
-
-    return (count, bytes_written)
+        # the previous version of the node may still be being written
+        store._wait_io(name)
+        store.writing[name] = (store.executor.submit(store.disk.write, name, data), data)
+        store.memory_size['writing'] += len(data)
+        bytes_written += len(data)
+        store._free(name, meta)
+
+    return (len(names), bytes_written)
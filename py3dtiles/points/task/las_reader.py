@@ -1,60 +1,166 @@
 import numpy as np
 import math
+import os
+import json
 import traceback
+import concurrent.futures
 import laspy
 import pyproj
-import struct
 from laspy.file import File
 import liblas
 from pickle import dumps as pdumps
+from py3dtiles.points.utils import points_to_frames, morton_sort
 
 
-def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
+# suggested location of the metadata cache (see read_all_metadata)
+METADATA_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'py3dtiles',
+    'las_metadata.json')
+
+
+def read_metadata(filename, read_srs):
+    """Reads what init needs to know about a las file
+
+    :return: a json serializable dict, or None if the file can't be read
+    """
+    try:
+        f = File(filename, mode='r')
+    except Exception as e:
+        print('Error opening {filename}. Skipping.'.format(**locals()))
+        print(e)
+        return None
+
+    header = f.header
+    metadata = {
+        'aabb': [list(header.get_min()), list(header.get_max())],
+        'count': header.count,
+        'color_scale': None,
+    }
+    record_dtype = point_dtype(header.data_format_id, header.data_record_length)
+    data_offset = header.data_offset
+    f.close()
+
+    # read the first points red channel
+    if 'red' in record_dtype.names:
+        first_points = np.memmap(
+            filename, dtype=record_dtype, mode='r', offset=data_offset,
+            shape=(min(10000, metadata['count']),))
+        if len(first_points) and np.max(first_points['red']) > 255:
+            metadata['color_scale'] = 1.0 / 255
+        del first_points
+    else:
+        metadata['color_scale'] = 1.0 / 255
+
+    if read_srs:
+        f = liblas.file.File(filename)
+        metadata['srs'] = f.header.srs.proj4 or ''
+
+    return metadata
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return [stat.st_mtime, stat.st_size]
+
+
+def load_metadata_cache(cache_filename):
+    try:
+        with open(cache_filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_metadata_cache(cache_filename, cache):
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        tmp_filename = '{}.{}'.format(cache_filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_filename, cache_filename)
+    except OSError as e:
+        print('Cannot write the metadata cache {}: {}'.format(cache_filename, e))
+
+
+def read_all_metadata(files, read_srs, metadata_cache=None):
+    """Reads the metadata of all files, using a process pool
+
+    With metadata_cache, metadata are cached in this file, keyed on the file
+    path, mtime and size, so only new or modified files are read again.
+    """
+    cache = load_metadata_cache(metadata_cache) if metadata_cache else {}
+
+    metadata = {}
+    to_read = []
+    for filename in files:
+        key = os.path.abspath(filename)
+        entry = cache.get(key)
+        try:
+            stamp = _file_stamp(filename)
+        except OSError:
+            stamp = None
+        if (entry is not None
+                and entry['stamp'] == stamp
+                and (not read_srs or 'srs' in entry['metadata'])):
+            metadata[filename] = entry['metadata']
+        else:
+            to_read.append(filename)
+
+    if len(to_read) > 1:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = list(executor.map(read_metadata, to_read, [read_srs] * len(to_read)))
+    else:
+        results = [read_metadata(filename, read_srs) for filename in to_read]
+
+    for filename, result in zip(to_read, results):
+        metadata[filename] = result
+        if result is not None:
+            cache[os.path.abspath(filename)] = {'stamp': _file_stamp(filename), 'metadata': result}
+
+    if metadata_cache and to_read:
+        save_metadata_cache(metadata_cache, cache)
+
+    return [metadata[filename] for filename in files]
+
+
+def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100, metadata_cache=None,
+         portion_size=1000000):
     aabb = None
     total_point_count = 0
     pointcloud_file_portions = []
     avg_min = np.array([0., 0., 0.])
 
-    for filename in files:
-        try:
-            f = File(filename, mode='r')
-        except Exception as e:
-            print('Error opening {filename}. Skipping.'.format(**locals()))
-            print(e)
+    read_srs = srs_out is not None and srs_in is None
+    all_metadata = read_all_metadata(files, read_srs, metadata_cache)
+
+    for filename, metadata in zip(files, all_metadata):
+        if metadata is None:
             continue
-        avg_min += (np.array(f.header.min) / len(files))
+        bb = np.array(metadata['aabb'])
+        avg_min += (bb[0] / len(files))
 
         if aabb is None:
-            aabb = np.array([f.header.get_min(), f.header.get_max()])
+            aabb = bb
         else:
-            bb = np.array([f.header.get_min(), f.header.get_max()])
             aabb[0] = np.minimum(aabb[0], bb[0])
             aabb[1] = np.maximum(aabb[1], bb[1])
 
-        count = int(f.header.count * fraction / 100)
+        count = int(metadata['count'] * fraction / 100)
         total_point_count += count
 
-        # read the first points red channel
         if color_scale is None:
-            if 'red' in f.point_format.lookup:
-                color_test_field = 'red'
-                if np.max(f.get_points()['point'][color_test_field][0:min(10000, f.header.count)]) > 255:
-                        color_scale = 1.0 / 255
-            else:
-                color_test_field = 'intensity'
-                color_scale = 1.0 / 255
+            color_scale = metadata['color_scale']
 
-        _1M = min(count, 1000000)
-        steps = math.ceil(count / _1M)
-        portions = [(i * _1M, min(count, (i + 1) * _1M)) for i in range(steps)]
+        size = min(count, portion_size)
+        steps = math.ceil(count / size)
+        portions = [(i * size, min(count, (i + 1) * size)) for i in range(steps)]
         for p in portions:
             pointcloud_file_portions += [(filename, p)]
 
-        if (srs_out is not None and srs_in is None):
-            f = liblas.file.File(filename)
-            if (f.header.srs.proj4 is not None
-                    and f.header.srs.proj4 != ''):
-                srs_in = pyproj.Proj(f.header.srs.proj4)
+        if read_srs and srs_in is None:
+            if metadata['srs']:
+                srs_in = pyproj.Proj(metadata['srs'])
             else:
                 raise Exception('\'{}\' file doesn\'t contain srs information. Please use the --srs_in option to declare it.'.format(filename))
 
@@ -68,86 +174,134 @@ def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
     }
 
 
-def run(_id, filename, offset_scale, portion, queue, projection, verbose):
-    '''
-    Reads points from a las file
-    '''
-    try:
-        f = laspy.file.File(filename, mode='r')
+_LEGACY_FIELDS = [
+    ('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'),
+    ('flag_byte', 'u1'), ('raw_classification', 'u1'), ('scan_angle_rank', 'i1'),
+    ('user_data', 'u1'), ('pt_src_id', '<u2')]
+_EXTENDED_FIELDS = [
+    ('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'),
+    ('return_byte', 'u1'), ('classification_flags', 'u1'), ('classification', 'u1'),
+    ('user_data', 'u1'), ('scan_angle', '<i2'), ('pt_src_id', '<u2'), ('gps_time', '<f8')]
+_GPS_TIME = [('gps_time', '<f8')]
+_RGB = [('red', '<u2'), ('green', '<u2'), ('blue', '<u2')]
 
-        point_count = portion[1] - portion[0]
+# fields of each point format, waveform formats (4, 5, 9 and 10) only append
+# a wave packet descriptor to the record so they share the layout of their base format
+POINT_FORMAT_FIELDS = {
+    0: _LEGACY_FIELDS,
+    1: _LEGACY_FIELDS + _GPS_TIME,
+    2: _LEGACY_FIELDS + _RGB,
+    3: _LEGACY_FIELDS + _GPS_TIME + _RGB,
+    4: _LEGACY_FIELDS + _GPS_TIME,
+    5: _LEGACY_FIELDS + _GPS_TIME + _RGB,
+    6: _EXTENDED_FIELDS,
+    7: _EXTENDED_FIELDS + _RGB,
+    8: _EXTENDED_FIELDS + _RGB + [('nir', '<u2')],
+    9: _EXTENDED_FIELDS,
+    10: _EXTENDED_FIELDS + _RGB + [('nir', '<u2')],
+}
 
-        step = min(point_count, max((point_count) // 10, 100000))
 
-        indices = [i for i in range(math.ceil((point_count) / step))]
+def point_dtype(point_format, record_length):
+    """Returns the structured numpy dtype of a point record
 
-        color_scale = offset_scale[3]
+    The itemsize is the record length declared in the header, so that extra
+    bytes are skipped.
+    """
+    fields = POINT_FORMAT_FIELDS[point_format]
+    return np.dtype({
+        'names': [name for name, _ in fields],
+        'formats': [fmt for _, fmt in fields],
+        'itemsize': record_length})
 
-        file_points = f.get_points()['point']
-        X = file_points['X']
-        Y = file_points['Y']
-        Z = file_points['Z']
-        # todo: attributes
-        if 'red' in f.point_format.lookup:
-            RED = file_points['red']
-            GREEN = file_points['green']
-            BLUE = file_points['blue']
-        else:
-            RED = file_points['intensity']
-            GREEN = file_points['intensity']
-            BLUE = file_points['intensity']
 
-        for index in indices:
-            start_offset = portion[0] + index * step
-            num = min(step, portion[1] - start_offset)
+def read_portion(filename, point_dtype, data_offset, portion, step):
+    """Reads the point records of a portion, step points at a time
+
+    Each chunk is a read-only memory map of the records, so nothing is copied
+    and memory usage is bounded by the chunk size instead of the file size.
+    """
+    for start in range(portion[0], portion[1], step):
+        num = min(step, portion[1] - start)
+        yield np.memmap(
+            filename, dtype=point_dtype, mode='r',
+            offset=data_offset + start * point_dtype.itemsize, shape=(num,))
 
-            # read scaled values and apply offset
-            x = X[start_offset:start_offset + num] * f.header.scale[0] + f.header.offset[0]
-            y = Y[start_offset:start_offset + num] * f.header.scale[1] + f.header.offset[1]
-            z = Z[start_offset:start_offset + num] * f.header.scale[2] + f.header.offset[2]
 
-            if projection:
-                x, y, z = pyproj.transform(projection[0], projection[1], x, y, z)
+def decode_xyz(points, scale, offset, offset_scale, projection):
+    """Returns the float32 (n, 3) coordinates of the point records"""
+    xyz = np.empty((len(points), 3), dtype=np.float64)
+    if projection:
+        for i, field in enumerate(('X', 'Y', 'Z')):
+            np.multiply(points[field], scale[i], out=xyz[:, i])
+        xyz += offset
+        x, y, z = pyproj.transform(projection[0], projection[1], xyz[:, 0], xyz[:, 1], xyz[:, 2])
+        xyz[:, 0], xyz[:, 1], xyz[:, 2] = x, y, z
+        xyz += offset_scale[0]
+        xyz *= offset_scale[1]
+    else:
+        # fold the las scale/offset and offset_scale in one multiply-add
+        for i, field in enumerate(('X', 'Y', 'Z')):
+            np.multiply(points[field], scale[i] * offset_scale[1][i], out=xyz[:, i])
+        xyz += (offset + offset_scale[0]) * offset_scale[1]
 
-            x = (x + offset_scale[0][0]) * offset_scale[1][0]
-            y = (y + offset_scale[0][1]) * offset_scale[1][1]
-            z = (z + offset_scale[0][2]) * offset_scale[1][2]
+    if offset_scale[2] is not None:
+        # Apply transformation matrix (because the tile's transform will contain
+        # the inverse of this matrix)
+        xyz = np.dot(xyz, offset_scale[2])
 
-            coords = np.vstack((x, y, z)).transpose()
+    return xyz.astype(np.float32)
 
-            if offset_scale[2] is not None:
-                # Apply transformation matrix (because the tile's transform will contain
-                # the inverse of this matrix)
-                coords = np.dot(coords, offset_scale[2])
 
-            coords = np.ascontiguousarray(coords.astype(np.float32))
+def decode_rgb(points, color_fields, color_scale):
+    """Returns the uint8 (n, 3) colors of the point records"""
+    rgb = np.empty((len(points), 3), dtype=np.uint8)
+    for i, field in enumerate(color_fields):
+        if color_scale is None:
+            rgb[:, i] = points[field]
+        else:
+            rgb[:, i] = points[field] * color_scale
+    return rgb
 
-            # Read colors
-            red = RED[start_offset:start_offset + num]
-            green = GREEN[start_offset:start_offset + num]
-            blue = BLUE[start_offset:start_offset + num]
 
-            if color_scale is None:
-                red = red.astype(np.uint8)
-                green = green.astype(np.uint8)
-                blue = blue.astype(np.uint8)
-            else:
-                red = (red * color_scale).astype(np.uint8)
-                green = (green * color_scale).astype(np.uint8)
-                blue = (blue * color_scale).astype(np.uint8)
+def run(_id, filename, offset_scale, portion, queue, projection, verbose, staging_dir=None, sort_aabb=None):
+    '''
+    Reads points from a las file
 
-            colors = np.vstack((red, green, blue)).transpose()
+    With sort_aabb, the points of each batch are sorted by their Morton code in it.
+    '''
+    try:
+        f = laspy.file.File(filename, mode='r')
+        scale = np.array(f.header.scale)
+        offset = np.array(f.header.offset)
+        data_offset = f.header.data_offset
+        record_dtype = point_dtype(f.header.data_format_id, f.header.data_record_length)
+        f.close()
 
-            queue.send_multipart([
-                ''.encode('ascii'),
-                pdumps({'xyz': coords, 'rgb': colors}),
-                struct.pack('>I', len(coords))], copy=False)
+        # todo: attributes
+        if 'red' in record_dtype.names:
+            color_fields = ('red', 'green', 'blue')
+        else:
+            color_fields = ('intensity', 'intensity', 'intensity')
+
+        point_count = portion[1] - portion[0]
+
+        step = min(point_count, max((point_count) // 10, 100000))
+
+        color_scale = offset_scale[3]
+
+        for file_points in read_portion(filename, record_dtype, data_offset, portion, step):
+            coords = decode_xyz(file_points, scale, offset, offset_scale, projection)
+            colors = decode_rgb(file_points, color_fields, color_scale)
+            if sort_aabb is not None:
+                coords, colors = morton_sort(coords, colors, sort_aabb)
+
+            queue.send_multipart(
+                [''.encode('ascii')] + points_to_frames(coords, colors, staging_dir), copy=False)
 
         queue.send_multipart([pdumps({'name': _id, 'total': 0})])
         # notify we're idle
         queue.send_multipart([b''])
-
-        f.close()
     except Exception as e:
         print('Exception while reading points from las file')
         print(e)
@@ -0,0 +1,189 @@
+import numpy as np
+import traceback
+import struct
+from pickle import dumps as pdumps
+
+from py3dtiles.points.utils import points_to_frames, morton_sort
+from py3dtiles.points.task.las_reader import point_dtype, decode_xyz, decode_rgb
+
+LASZIP_VLR_USER_ID = b'laszip encoded'
+LASZIP_VLR_RECORD_ID = 22204
+
+
+def read_header(filename):
+    """Reads the public header block and the laszip vlr of a laz file
+
+    laspy can't read compressed files by itself, but the header and the vlrs
+    aren't compressed so they're decoded here directly.
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(375)
+        header_size, data_offset, vlr_count = struct.unpack_from('<HII', raw, 94)
+        point_format, record_length, point_count = struct.unpack_from('<BHI', raw, 104)
+        scale = np.array(struct.unpack_from('<3d', raw, 131))
+        offset = np.array(struct.unpack_from('<3d', raw, 155))
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', raw, 179)
+        version = struct.unpack_from('<BB', raw, 24)
+        if version >= (1, 4) and point_count == 0:
+            point_count = struct.unpack_from('<Q', raw, 247)[0]
+
+        laszip_vlr = None
+        f.seek(header_size)
+        for _ in range(vlr_count):
+            _, user_id, record_id, length, _ = struct.unpack('<H16sHH32s', f.read(54))
+            record = f.read(length)
+            if user_id.rstrip(b'\0') == LASZIP_VLR_USER_ID and record_id == LASZIP_VLR_RECORD_ID:
+                laszip_vlr = record
+
+    if laszip_vlr is None:
+        raise Exception('\'{}\' is not a laz file (no laszip vlr found)'.format(filename))
+
+    return {
+        # the 2 highest bits flag compression
+        'point_format': point_format & 0x3f,
+        'record_length': record_length,
+        'point_count': point_count,
+        'scale': scale,
+        'offset': offset,
+        'aabb': np.array([[min_x, min_y, min_z], [max_x, max_y, max_z]]),
+        'data_offset': data_offset,
+        'laszip_vlr': laszip_vlr,
+    }
+
+
+def read_chunk_table(filename, header):
+    """Returns the (point_count, byte_offset, byte_count) of each compressed chunk"""
+    import lazrs
+
+    with open(filename, 'rb') as f:
+        f.seek(header['data_offset'])
+        table = lazrs.read_chunk_table(f, lazrs.LazVlr(header['laszip_vlr']))
+        # read_chunk_table leaves the file at the beginning of the first chunk
+        byte_offset = f.tell()
+
+    chunks = []
+    remaining = header['point_count']
+    for point_count, byte_count in table:
+        # with fixed size chunks, the last chunk is usually incomplete
+        point_count = min(point_count, remaining)
+        chunks.append((point_count, byte_offset, byte_count))
+        byte_offset += byte_count
+        remaining -= point_count
+    return chunks
+
+
+def read_chunks(filename, header, chunks):
+    """Decompresses consecutive chunks and returns their point records"""
+    import lazrs
+
+    record_dtype = point_dtype(header['point_format'], header['record_length'])
+    points = np.empty(sum(c[0] for c in chunks), dtype=record_dtype)
+    with open(filename, 'rb') as f:
+        f.seek(chunks[0][1])
+        compressed = f.read(sum(c[2] for c in chunks))
+    lazrs.decompress_points_with_chunk_table(
+        compressed,
+        header['laszip_vlr'],
+        points.view(np.uint8),
+        [(c[0], c[2]) for c in chunks])
+    return points
+
+
+def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100, portion_size=1000000):
+    aabb = None
+    total_point_count = 0
+    pointcloud_file_portions = []
+    avg_min = np.array([0., 0., 0.])
+
+    for filename in files:
+        try:
+            header = read_header(filename)
+            chunks = read_chunk_table(filename, header)
+        except Exception as e:
+            print('Error opening {filename}. Skipping.'.format(**locals()))
+            print(e)
+            continue
+        avg_min += (header['aabb'][0] / len(files))
+
+        if aabb is None:
+            aabb = header['aabb']
+        else:
+            aabb[0] = np.minimum(aabb[0], header['aabb'][0])
+            aabb[1] = np.maximum(aabb[1], header['aabb'][1])
+
+        count = int(header['point_count'] * fraction / 100)
+        total_point_count += count
+
+        # read the first points red channel, from the first chunk only
+        if color_scale is None:
+            if 'red' in point_dtype(header['point_format'], header['record_length']).names:
+                first_points = read_chunks(filename, header, chunks[0:1])
+                if np.max(first_points['red'][0:min(10000, count)]) > 255:
+                    color_scale = 1.0 / 255
+            else:
+                color_scale = 1.0 / 255
+
+        # portions are made of whole chunks, so each worker only decompresses its own
+        start = 0
+        portion_chunks = []
+        for chunk in chunks:
+            if start >= count:
+                break
+            portion_chunks.append(chunk)
+            end = start + sum(c[0] for c in portion_chunks)
+            if end - start >= portion_size or end >= count:
+                pointcloud_file_portions += [(filename, (start, min(end, count), portion_chunks))]
+                start = end
+                portion_chunks = []
+
+        if (srs_out is not None and srs_in is None):
+            raise Exception('\'{}\' file doesn\'t contain srs information. Please use the --srs_in option to declare it.'.format(filename))
+
+    return {
+        'portions': pointcloud_file_portions,
+        'aabb': aabb,
+        'color_scale': color_scale,
+        'srs_in': srs_in,
+        'point_count': total_point_count,
+        'avg_min': avg_min
+    }
+
+
+def run(_id, filename, offset_scale, portion, queue, projection, verbose, staging_dir=None, sort_aabb=None):
+    '''
+    Reads points from a laz file
+
+    With sort_aabb, the points of each batch are sorted by their Morton code in it.
+    '''
+    try:
+        header = read_header(filename)
+
+        # todo: attributes
+        if 'red' in point_dtype(header['point_format'], header['record_length']).names:
+            color_fields = ('red', 'green', 'blue')
+        else:
+            color_fields = ('intensity', 'intensity', 'intensity')
+
+        color_scale = offset_scale[3]
+
+        start = portion[0]
+        for chunk in portion[2]:
+            # the last chunk may be partially read (see fraction)
+            file_points = read_chunks(filename, header, [chunk])[0:portion[1] - start]
+            start += len(file_points)
+
+            coords = decode_xyz(file_points, header['scale'], header['offset'], offset_scale, projection)
+            colors = decode_rgb(file_points, color_fields, color_scale)
+            if sort_aabb is not None:
+                coords, colors = morton_sort(coords, colors, sort_aabb)
+
+            queue.send_multipart(
+                [''.encode('ascii')] + points_to_frames(coords, colors, staging_dir), copy=False)
+
+        queue.send_multipart([pdumps({'name': _id, 'total': 0})])
+        # notify we're idle
+        queue.send_multipart([b''])
+    except Exception as e:
+        print('Exception while reading points from laz file')
+        print(e)
+        traceback.print_exc()
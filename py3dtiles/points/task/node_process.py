@@ -3,36 +3,99 @@ import time
 import traceback
 import pickle
 import struct
+import threading
+from collections import OrderedDict
 
 from py3dtiles.points.node_catalog import NodeCatalog
+from py3dtiles.points.utils import frames_to_points, points_frame_count
 
+# sent instead of the node data, when the worker still has it decoded (see CatalogCache)
+CACHED_NODE = b'cached'
+CATALOG_CACHE_SIZE = 8
 
-def _forward_unassigned_points(node, queue, log_file):
+
+class CatalogCache():
+    """The NodeCatalog of the last nodes processed by a worker
+
+    The main process keeps the same cache for each worker, without the
+    catalogs, so that it knows which nodes it doesn't need to send.
+    """
+
+    def __init__(self, size=CATALOG_CACHE_SIZE):
+        self.size = size
+        self.catalogs = OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.catalogs
+
+    def get(self, name):
+        return self.catalogs[name]
+
+    def put(self, name, node_catalog=None):
+        # the root node state is never saved
+        if len(name) == 0:
+            return
+        self.catalogs[name] = node_catalog
+        self.catalogs.move_to_end(name)
+        while len(self.catalogs) > self.size:
+            self.catalogs.popitem(last=False)
+
+
+class _LockedQueue():
+    """Lets the threads processing sibling subtrees share the worker socket"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.lock = threading.Lock()
+
+    def send_multipart(self, *args, **kwargs):
+        with self.lock:
+            return self.queue.send_multipart(*args, **kwargs)
+
+
+def _forward_unassigned_points(node, queue, log_file, staging_dir):
     total = 0
 
-    result = node.dump_pending_points()
+    result = node.dump_pending_points(staging_dir)
 
     for r in result:
         if len(r) > 0:
             if log_file is not None:
                 print('    -> put on queue ({},{})'.format(r[0], r[2]), file=log_file)
             total += r[2]
-            queue.send_multipart([
-                r[0],
-                r[1],
-                struct.pack('>I', r[2])], copy=False, block=False)
+            queue.send_multipart([r[0]] + r[1], copy=False, block=False)
 
     return total
 
 
-def _flush(node_catalog, scale, node, queue, max_depth=1, force_forward=False, log_file=None, depth=0):
+def _flush_child(node_catalog, scale, name, points, queue, max_depth, force_forward, log_file, staging_dir, depth):
+    child = node_catalog.get_node(name)
+    for xyz, rgb in points:
+        child.insert(node_catalog, scale, xyz, rgb)
+    return _flush(node_catalog, scale, child, queue, max_depth, force_forward, log_file, staging_dir, depth)
+
+
+def _flush(node_catalog, scale, node, queue, max_depth=1, force_forward=False, log_file=None, staging_dir=None, depth=0,
+           executor=None):
     if depth >= max_depth:
         threshold = 0 if force_forward else 10000
         if node.get_pending_points_count() > threshold:
-            return _forward_unassigned_points(node, queue, log_file)
+            return _forward_unassigned_points(node, queue, log_file, staging_dir)
         else:
             return 0
 
+    if executor is not None and node.children is not None:
+        # the children subtrees are independent: fill and flush them in parallel
+        points = {}
+        for name, xyz, rgb in node.take_pending_points():
+            points.setdefault(name, []).append((xyz, rgb))
+        futures = [
+            executor.submit(
+                _flush_child, node_catalog, scale, name, points.get(name, []), queue,
+                max_depth, force_forward, log_file, staging_dir, depth + 1)
+            for name in node.children]
+        return sum(f.result() for f in futures)
+
     node.flush_pending_points(node_catalog, scale)
 
     total = 0
@@ -42,12 +105,12 @@ def _flush(node_catalog, scale, node, queue, max_depth=1, force_forward=False, l
         # release node
         del node
         for name in children:
-            total += _flush(node_catalog, scale, node_catalog.get_node(name), queue, max_depth, force_forward, log_file, depth + 1)
+            total += _flush(node_catalog, scale, node_catalog.get_node(name), queue, max_depth, force_forward, log_file, staging_dir, depth + 1)
 
     return total
 
 
-def _balance(node_catalog, node, max_depth=1, depth=0):
+def _balance(node_catalog, node, max_depth=1, depth=0, executor=None):
     if depth >= max_depth:
         return 0
 
@@ -55,7 +118,13 @@ def _balance(node_catalog, node, max_depth=1, depth=0):
         node.grid.balance(node.aabb_size, node.aabb[0], node.inv_aabb_size)
         node.dirty = True
 
-    if node.children is not None:
+    if executor is not None and node.children is not None:
+        futures = [
+            executor.submit(_balance, node_catalog, node_catalog.get_node(name), max_depth, depth + 1)
+            for name in node.children]
+        for f in futures:
+            f.result()
+    elif node.children is not None:
         # then _flush children
         children = node.children
         # release node
@@ -68,10 +137,10 @@ def _balance(node_catalog, node, max_depth=1, depth=0):
                 depth + 1)
 
 
-def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
-    node_catalog = NodeCatalog(nodes, name, octree_metadata)
-
+def _process(node_catalog, octree_metadata, name, raw_datas, queue, begin, log_file, staging_dir=None, executor=None):
     log_enabled = log_file is not None
+    if executor is not None:
+        queue = _LockedQueue(queue)
 
     if log_enabled:
         print('[>] process_node: "{}", {}'.format(
@@ -96,9 +165,9 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
         if log_enabled:
             print('  -> read source [{}]'.format(time.time() - begin), file=log_file, flush=True)
 
-        data = pickle.loads(raw_data)
+        xyz, rgb = frames_to_points(raw_data)
 
-        point_count = len(data['xyz'])
+        point_count = len(xyz)
 
         if log_enabled:
             print('  -> insert {} [{} points]/ {} files [{}]'.format(
@@ -106,7 +175,7 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
                 len(raw_datas), time.time() - begin), file=log_file, flush=True)
 
         # insert points in node (no children handling here)
-        node.insert(node_catalog, octree_metadata.scale, data['xyz'], data['rgb'], halt_at_depth == 0)
+        node.insert(node_catalog, octree_metadata.scale, xyz, rgb, halt_at_depth == 0)
 
         total += point_count
 
@@ -114,12 +183,13 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
             print('  -> _flush [{}]'.format(time.time() - begin), file=log_file, flush=True)
         # _flush push pending points (= call insert) from level N to level N + 1
         # (_flush is recursive)
-        written = _flush(node_catalog, octree_metadata.scale, node, queue, halt_at_depth - 1, index == len(raw_datas) - 1, log_file)
+        written = _flush(node_catalog, octree_metadata.scale, node, queue, halt_at_depth - 1, index == len(raw_datas) - 1, log_file, staging_dir,
+                         executor=executor)
         total -= written
 
         index += 1
 
-    _balance(node_catalog, node, halt_at_depth - 1)
+    _balance(node_catalog, node, halt_at_depth - 1, executor=executor)
 
     if log_enabled:
         print('save on disk {} [{}]'.format(name, time.time() - begin), file=log_file)
@@ -135,7 +205,12 @@ def _process(nodes, octree_metadata, name, raw_datas, queue, begin, log_file):
     return (total, data)
 
 
-def run(work, octree_metadata, queue, verbose):
+def run(work, octree_metadata, queue, verbose, staging_dir=None, catalog_cache=None, executor=None):
+    """Processes a node job
+
+    With an executor, the subtrees of the children of each node are
+    processed in parallel (the grid kernels release the GIL).
+    """
     try:
         begin = time.time()
         log_enabled = verbose >= 2
@@ -149,13 +224,24 @@ def run(work, octree_metadata, queue, verbose):
 
         i = 0
         while i < len(work):
-            name = work[i]
-            node = work[i + 1]
+            name = work[i].bytes
+            node = work[i + 1].buffer
             count = struct.unpack('>I', work[i + 2])[0]
-            filenames = work[i + 3:i + 3 + count]
-            i += 3 + count
-            result, data = _process(node, octree_metadata, name, filenames, queue, begin, log_file)
+            i += 3
+            batches = []
+            for _ in range(count):
+                frame_count = points_frame_count(work[i])
+                batches.append(work[i:i + frame_count])
+                i += frame_count
+
+            if node == CACHED_NODE:
+                node_catalog = catalog_cache.get(name)
+            else:
+                node_catalog = NodeCatalog(node, name, octree_metadata)
+            result, data = _process(node_catalog, octree_metadata, name, batches, queue, begin, log_file, staging_dir, executor)
             total += result
+            if catalog_cache is not None:
+                catalog_cache.put(name, node_catalog)
 
             queue.send_multipart([pickle.dumps({
                 'name': name,
@@ -3,21 +3,20 @@ import pickle
 import struct
 import os
 import py3dtiles
-import lz4.frame as gzip
-from py3dtiles.points.utils import name_to_filename
+from py3dtiles.points import codec
+from py3dtiles.points.utils import name_to_filename, bytes_to_node_columns
 
 
-class _DummyNode():
-    def __init__(self, _bytes):
-        if 'children' in _bytes:
-            self.children = _bytes['children']
-            self.grid = _bytes['grid']
-        else:
-            self.children = None
-            self.points = _bytes['points']
+def node_bytes_to_points(data, include_rgb):
+    """Returns the points of a serialized node (see Node.save_to_bytes), in the Node.get_points format"""
+    columns = bytes_to_node_columns(data)
+    xyz = columns.xyz.view(np.uint8).ravel()
+    if include_rgb:
+        return np.concatenate((xyz, columns.rgb.ravel()))
+    return xyz
 
 
-def points_to_pnts(name, points, out_folder, include_rgb):
+def points_to_tile(points, include_rgb):
     count = int(len(points) / (3 * 4 + (3 if include_rgb else 0)))
 
     if count == 0:
@@ -38,6 +37,15 @@ def points_to_pnts(name, points, out_folder, include_rgb):
     tile.header = py3dtiles.pnts.PntsHeader()
     tile.header.sync(body)
 
+    return count, tile
+
+
+def points_to_pnts(name, points, out_folder, include_rgb):
+    count, tile = points_to_tile(points, include_rgb)
+
+    if count == 0:
+        return 0, None
+
     filename = name_to_filename(out_folder, name, '.pnts')
 
     assert not os.path.exists(filename), '{} already written'.format(filename)
@@ -54,13 +62,25 @@ def node_to_pnts(name, node, out_folder, include_rgb):
 
 
 def run(sender, data, node_name, folder, write_rgb):
+    """Writes the .pnts files of the nodes in data
+
+    Without a folder (remote workers don't share the output folder), the
+    tiles are sent back to the main process, as name/content frames pairs.
+    """
     # we can safely write the .pnts file
     if len(data):
-        root = pickle.loads(gzip.decompress(data))
+        root = pickle.loads(codec.decompress(data))
         # print('write ', node_name.decode('ascii'))
         total = 0
+        tiles = []
         for name in root:
-            node = _DummyNode(pickle.loads(root[name]))
-            total += node_to_pnts(name, node, folder, write_rgb)[0]
-
-        sender.send_multipart([b'pnts', struct.pack('>I', total), node_name])
+            points = node_bytes_to_points(root[name], write_rgb)
+            if folder is None:
+                count, tile = points_to_tile(points, write_rgb)
+                if count > 0:
+                    tiles += [name, bytes(tile.to_array())]
+                total += count
+            else:
+                total += points_to_pnts(name, points, folder, write_rgb)[0]
+
+        sender.send_multipart([b'pnts', struct.pack('>I', total), node_name] + tiles)
@@ -1,20 +1,175 @@
 import numpy as np
 import math
+import os
 import traceback
 import pyproj
-import struct
+from itertools import islice
 from pickle import dumps as pdumps
+from py3dtiles.points.utils import points_to_frames, morton_sort
 
 
-def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
+# size of the blocks read by the single pass mode
+BLOCK_SIZE = 8 * 1024 * 1024
+SAMPLE_COUNT = 100
+SAMPLE_SIZE = 64 * 1024
+
+
+class OutsideAabbException(Exception):
+    """Raised when points are outside the aabb given to the single pass mode, or estimated by it"""
+    pass
+
+
+def parse_block(block):
+    """Parses a block of lines of whitespace separated numbers
+
+    The block is converted in a single vectorized call, instead of converting
+    each value in python.
+
+    :param block: bytes lines, all with the same number of values
+    :return: a (line count, column count) float64 array
+    """
+    first_line_end = block.find(b'\n')
+    columns = len(block[:first_line_end if first_line_end >= 0 else len(block)].split())
+    rows = block.count(b'\n') + (0 if block.endswith(b'\n') else 1)
+    points = np.fromstring(block, dtype=np.float64, sep=' ')
+    if columns == 0 or points.shape[0] != rows * columns:
+        raise ValueError('Inconsistent column count, {} expected'.format(columns))
+    return points.reshape((rows, columns))
+
+
+def parse_lines(lines):
+    """Parses lines of whitespace separated numbers, see parse_block"""
+    return parse_block(b''.join(lines))
+
+
+def read_aabb_sidecar(filename):
+    """Reads the aabb of filename from a '<filename>.aabb' file, if it exists
+
+    The sidecar contains 6 whitespace separated values: xmin ymin zmin xmax ymax zmax.
+    """
+    if not os.path.exists(filename + '.aabb'):
+        return None
+    with open(filename + '.aabb', 'rb') as f:
+        return np.fromstring(f.read(), dtype=np.float64, sep=' ').reshape((2, 3))
+
+
+def sample_file(filename, size):
+    """Parses evenly spaced samples of a file
+
+    Only the lines starting before size are sampled, as size may cut a
+    line (see _read_byte_range).
+
+    :return: (the average line length in bytes, the aabb of the sampled points).
+    Both are exact if size is small enough to be read entirely.
+    """
+    line_count = 0
+    byte_count = 0
+    aabb = None
+    with open(filename, 'rb') as f:
+        for start in sorted(set(np.linspace(0, max(0, size - SAMPLE_SIZE), SAMPLE_COUNT, dtype=np.int64))):
+            if start > 0:
+                # the line overlapping start belongs to the previous sample
+                f.seek(start - 1)
+                f.readline()
+            else:
+                f.seek(0)
+            position = f.tell()
+            if position >= size:
+                continue
+            block = f.read(min(SAMPLE_SIZE, size - position))
+            if not block.endswith(b'\n'):
+                # complete the last line, as it starts before the end of the sample
+                block += f.readline()
+            points = parse_block(block)[:, :3]
+            line_count += points.shape[0]
+            byte_count += len(block)
+            block_aabb = np.array([np.min(points, axis=0), np.max(points, axis=0)])
+            if aabb is None:
+                aabb = block_aabb
+            else:
+                aabb[0] = np.minimum(aabb[0], block_aabb[0])
+                aabb[1] = np.maximum(aabb[1], block_aabb[1])
+            if size <= SAMPLE_SIZE:
+                break
+
+    return byte_count / max(line_count, 1), aabb
+
+
+def _init_single_pass(filename, fraction, aabb, portion_size=1000000):
+    """Builds the portions of a file by splitting it by size, without parsing it
+
+    The point count of the portions is estimated from the average line length
+    of a sample of the file, the readers send the exact count once done.
+    """
+    size = int(os.path.getsize(filename) * fraction / 100)
+    line_length, sampled_aabb = sample_file(filename, size)
+
+    if aabb is None:
+        aabb = read_aabb_sidecar(filename)
+    if aabb is None:
+        aabb = sampled_aabb
+        if size > SAMPLE_COUNT * SAMPLE_SIZE:
+            # the extreme points have probably been missed, add some margin
+            margin = (aabb[1] - aabb[0]) * 0.05
+            aabb = np.array([aabb[0] - margin, aabb[1] + margin])
+
+    count = int(size / line_length)
+    portion_bytes = int(line_length * portion_size)
+    portions = []
+    for seek_start in range(0, size, portion_bytes):
+        seek_end = min(size, seek_start + portion_bytes)
+        estimated_start = int(seek_start / line_length)
+        portions += [(estimated_start, max(estimated_start + 1, int(seek_end / line_length)), seek_start, seek_end)]
+
+    return count, np.array(aabb, dtype=np.float64), portions
+
+
+def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100, single_pass=False, aabb=None,
+         portion_size=1000000):
+    """Reads the aabb and builds the portions of xyz files
+
+    By default, every line is parsed to get the exact aabb and point count.
+    With single_pass, files are split by size and the aabb is read from
+    the aabb parameter, from a '<filename>.aabb' sidecar or from a sample
+    of the file. The aabb is added to the portions, and the readers count
+    the points outside of it (see run).
+
+    portion_size must be a multiple of 100000 (the lines are parsed by
+    batches of 100000 lines).
+    """
+    user_aabb = aabb
     aabb = None
     total_point_count = 0
     pointcloud_file_portions = []
     avg_min = np.array([0.0, 0.0, 0.0])
 
     for filename in files:
+        if srs_out is not None and srs_in is None:
+            raise Exception(
+                "'{}' file doesn't contain srs information. Please use the --srs_in option to declare it.".format(
+                    filename
+                )
+            )
+
+        if single_pass:
+            try:
+                count, file_aabb, portions = _init_single_pass(filename, fraction, user_aabb, portion_size)
+            except Exception as e:
+                print("Error opening {filename}. Skipping.".format(**locals()))
+                print(e)
+                continue
+
+            total_point_count += count
+            pointcloud_file_portions += [(filename, p) for p in portions]
+            if aabb is None:
+                aabb = file_aabb
+            else:
+                aabb[0] = np.minimum(aabb[0], file_aabb[0])
+                aabb[1] = np.maximum(aabb[1], file_aabb[1])
+            continue
+
         try:
-            f = open(filename, "r")
+            f = open(filename, "rb")
         except Exception as e:
             print("Error opening {filename}. Skipping.".format(**locals()))
             print(e)
@@ -23,21 +178,17 @@ def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
         count = 0
         seek_values = []
         while True:
-            batch = 10000
-            points = np.zeros((batch, 3))
+            # must divide the portion size, to get the seek value of each portion
+            batch = 100000
 
             offset = f.tell()
-            for i in range(batch):
-                line = f.readline()
-                if not line:
-                    points = np.resize(points, (i, 3))
-                    break
-                points[i] = [float(s) for s in line.split(" ")][:3]
-
-            if points.shape[0] == 0:
+            lines = list(islice(f, batch))
+            if not lines:
                 break
 
-            if not count % 1000000:
+            points = parse_lines(lines)[:, :3]
+
+            if not count % portion_size:
                 seek_values += [offset]
 
             count += points.shape[0]
@@ -55,21 +206,21 @@ def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
         # We need an exact point count
         total_point_count += count * fraction / 100
 
-        _1M = min(count, 1000000)
-        steps = math.ceil(count / _1M)
+        size = min(count, portion_size)
+        steps = math.ceil(count / size)
         assert steps == len(seek_values)
         portions = [
-            (i * _1M, min(count, (i + 1) * _1M), seek_values[i]) for i in range(steps)
+            (i * size, min(count, (i + 1) * size), seek_values[i]) for i in range(steps)
         ]
         for p in portions:
             pointcloud_file_portions += [(filename, p)]
 
-        if srs_out is not None and srs_in is None:
-            raise Exception(
-                "'{}' file doesn't contain srs information. Please use the --srs_in option to declare it.".format(
-                    filename
-                )
-            )
+        f.close()
+
+    if single_pass and aabb is not None:
+        # the octree can't grow, so the readers check that their points are in its aabb
+        bounds = tuple(aabb.ravel().tolist())
+        pointcloud_file_portions = [(filename, p + (bounds,)) for filename, p in pointcloud_file_portions]
 
     return {
         "portions": pointcloud_file_portions,
@@ -81,7 +232,41 @@ def init(files, color_scale=None, srs_in=None, srs_out=None, fraction=100):
     }
 
 
-def run(_id, filename, offset_scale, portion, queue, projection, verbose):
+def _read_lines(f, portion):
+    """Reads the lines of a (start, end, seek) portion, step lines at a time"""
+    point_count = portion[1] - portion[0]
+
+    step = min(point_count, max((point_count) // 10, 100000))
+
+    f.seek(portion[2])
+
+    for i in range(0, point_count, step):
+        lines = list(islice(f, min(step, point_count - i)))
+        if not lines:
+            break
+        yield parse_lines(lines)
+
+
+def _read_byte_range(f, seek_start, seek_end):
+    """Reads the lines starting between seek_start and seek_end, by blocks"""
+    if seek_start > 0:
+        # the line overlapping seek_start belongs to the previous portion
+        f.seek(seek_start - 1)
+        f.readline()
+    position = f.tell()
+
+    while position < seek_end:
+        block = f.read(min(BLOCK_SIZE, seek_end - position))
+        if not block:
+            break
+        if not block.endswith(b'\n'):
+            # complete the last line, as it starts before seek_end
+            block += f.readline()
+        position += len(block)
+        yield parse_block(block)
+
+
+def run(_id, filename, offset_scale, portion, queue, projection, verbose, staging_dir=None, sort_aabb=None):
     """
     Reads points from a xyz file
 
@@ -93,34 +278,32 @@ def run(_id, filename, offset_scale, portion, queue, projection, verbose):
     - 6 features mean XYZRGB
 
     (*) See: https://docs.safe.com/fme/html/FME_Desktop_Documentation/FME_ReadersWriters/pointcloudxyz/pointcloudxyz.htm
-    """
-    try:
-        f = open(filename, "r")
 
-        point_count = portion[1] - portion[0]
+    With sort_aabb, the points of each batch are sorted by their Morton code in it.
 
-        step = min(point_count, max((point_count) // 10, 100000))
+    The points of single pass portions must be in their aabb, else they would be
+    clamped into the wrong nodes: they are counted in the 'outside_aabb' value of
+    the status message, and the conversion fails (see OutsideAabbException).
+    """
+    try:
+        f = open(filename, "rb")
 
-        f.seek(portion[2])
+        read_count = 0
+        outside_aabb = 0
 
-        feature_nb = 7
+        if len(portion) == 5:
+            blocks = _read_byte_range(f, portion[2], portion[3])
+            aabb = np.array(portion[4]).reshape((2, 3))
+        else:
+            blocks = _read_lines(f, portion)
+            aabb = None
 
-        for i in range(0, point_count, step):
-            points = np.zeros((step, feature_nb), dtype=np.float32)
+        for points in blocks:
+            read_count += points.shape[0]
 
-            for j in range(0, step):
-                line = f.readline()
-                if not line:
-                    points = np.resize(points, (j, feature_nb))
-                    break
-                line_features = [float(s) for s in line.split(" ")]
-                if len(line_features) == 3:
-                    line_features += [None] * 4  # Insert intensity and RGB
-                elif len(line_features) == 4:
-                    line_features += [None] * 3  # Insert RGB
-                elif len(line_features) == 6:
-                    line_features.insert(3, None)  # Insert intensity
-                points[j] = line_features
+            if aabb is not None:
+                outside_aabb += np.count_nonzero(
+                    np.any((points[:, :3] < aabb[0]) | (points[:, :3] > aabb[1]), axis=1))
 
             x, y, z = [points[:, c] for c in [0, 1, 2]]
 
@@ -140,19 +323,27 @@ def run(_id, filename, offset_scale, portion, queue, projection, verbose):
 
             coords = np.ascontiguousarray(coords.astype(np.float32))
 
-            # Read colors: 3 last columns of the point cloud
-            colors = points[:, -3:].astype(np.uint8)
+            # Read colors: 3 last columns of the point cloud (XYZRGB or XYZIRGB)
+            if points.shape[1] >= 6:
+                colors = points[:, -3:].astype(np.uint8)
+            else:
+                colors = np.zeros((points.shape[0], 3), dtype=np.uint8)
+
+            if sort_aabb is not None:
+                coords, colors = morton_sort(coords, colors, sort_aabb)
 
             queue.send_multipart(
-                [
-                    "".encode("ascii"),
-                    pdumps({"xyz": coords, "rgb": colors}),
-                    struct.pack(">I", len(coords)),
-                ],
+                ["".encode("ascii")] + points_to_frames(coords, colors, staging_dir),
                 copy=False,
             )
 
-        queue.send_multipart([pdumps({"name": _id, "total": 0})])
+        queue.send_multipart([pdumps({
+            "name": _id,
+            "total": 0,
+            # only an estimation of the point count is known for size based portions
+            "point_count_delta": read_count - (portion[1] - portion[0]),
+            "outside_aabb": outside_aabb,
+        })])
         # notify we're idle
         queue.send_multipart([b""])
 
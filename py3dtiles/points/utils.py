@@ -1,5 +1,8 @@
 import numpy as np
 import os
+import struct
+import uuid
+from collections import namedtuple
 from enum import Enum
 from io import StringIO
 
@@ -40,6 +43,160 @@ def name_to_filename(working_dir, nameb, suffix=''):
     return filename
 
 
+# header of a points batch: the point count, and whether the points are
+# sent inline or have been staged to a file
+POINTS_HEADER = struct.Struct('>IB')
+
+
+def points_to_frames(xyz, rgb, staging_dir=None):
+    """Returns the zmq frames of a points batch
+
+    A fixed size header followed by the raw float32 xyz and uint8 rgb
+    buffers, sent as is without pickling nor copy. If staging_dir is
+    set, the buffers are written to a file in this folder instead and
+    only its filename is sent.
+    """
+    if staging_dir is None:
+        return [POINTS_HEADER.pack(len(xyz), 0), xyz, rgb]
+
+    # unique across the hosts sharing staging_dir (see convert --bind)
+    filename = os.path.join(staging_dir, uuid.uuid4().hex)
+    with open(filename, 'wb') as f:
+        f.write(xyz.data)
+        f.write(rgb.data)
+    return [POINTS_HEADER.pack(len(xyz), 1), filename.encode()]
+
+
+def points_count(header):
+    """Returns the point count of a points batch from its header frame"""
+    return POINTS_HEADER.unpack(header)[0]
+
+
+def points_frame_count(header):
+    """Returns the number of frames of a points batch, header included"""
+    return 2 if POINTS_HEADER.unpack(header)[1] else 3
+
+
+def frames_to_points(frames):
+    """Returns the (xyz, rgb) arrays of a points batch received as zmq frames
+
+    Inline arrays are views of the frames buffers. Staged batches are read
+    and their file is removed, as a batch is only processed once.
+    """
+    count, staged = POINTS_HEADER.unpack(frames[0])
+    if staged:
+        filename = bytes(frames[1]).decode()
+        data = np.fromfile(filename, dtype=np.uint8)
+        os.remove(filename)
+        xyz = data[:count * 3 * 4].view(np.float32).reshape((count, 3))
+        rgb = data[count * 3 * 4:].reshape((count, 3))
+    else:
+        xyz = np.frombuffer(frames[1], dtype=np.float32).reshape((count, 3))
+        rgb = np.frombuffer(frames[2], dtype=np.uint8).reshape((count, 3))
+    return xyz, rgb
+
+
+def split_points_batch(data):
+    """Returns the frames of an inline points batch from their concatenation"""
+    count = points_count(data[:POINTS_HEADER.size])
+    xyz_end = POINTS_HEADER.size + count * 3 * 4
+    return [data[:POINTS_HEADER.size], data[POINTS_HEADER.size:xyz_end], data[xyz_end:]]
+
+
+# columnar layout of a serialized node (see Node.save_to_bytes): this header
+# (has_grid, grid cell_count, point count, offsets count, children length),
+# the last char of the children names padded to 4 bytes, the offsets of the
+# grid cells in the points, then all the xyz and all the rgb of the node
+NODE_HEADER = struct.Struct('<I3iIII')
+
+NodeColumns = namedtuple('NodeColumns', ['has_grid', 'cell_count', 'children', 'offsets', 'xyz', 'rgb'])
+
+
+def node_columns_to_bytes(columns):
+    header = NODE_HEADER.pack(
+        columns.has_grid, *columns.cell_count, len(columns.xyz), len(columns.offsets), len(columns.children))
+    padding = bytes(-len(columns.children) % 4)
+    return b''.join([
+        header, columns.children, padding,
+        columns.offsets.astype(np.uint32, copy=False),
+        np.ascontiguousarray(columns.xyz, dtype=np.float32),
+        np.ascontiguousarray(columns.rgb, dtype=np.uint8)])
+
+
+def bytes_to_node_columns(data):
+    """Returns the NodeColumns of a serialized node, its arrays are views of data"""
+    has_grid, cx, cy, cz, count, offsets_count, children_count = NODE_HEADER.unpack_from(data)
+    position = NODE_HEADER.size
+    children = bytes(data[position:position + children_count])
+    position += children_count + (-children_count % 4)
+    offsets = np.frombuffer(data, dtype=np.uint32, count=offsets_count, offset=position)
+    position += offsets.nbytes
+    xyz = np.frombuffer(data, dtype=np.float32, count=count * 3, offset=position).reshape((count, 3))
+    position += xyz.nbytes
+    rgb = np.frombuffer(data, dtype=np.uint8, count=count * 3, offset=position).reshape((count, 3))
+    return NodeColumns(bool(has_grid), (cx, cy, cz), children, offsets, xyz, rgb)
+
+
+# bits of each coordinate in the Morton codes (63 bits codes)
+MORTON_BITS = 21
+
+
+def _spread_bits(v):
+    # inserts 2 zero bits between each of the 21 lowest bits of v
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+
+def _z_splits(aabb):
+    # whether each level of the tree made by split_aabb splits z (octree) or not (quadtree)
+    size = aabb[1] - aabb[0]
+    splits = []
+    for _ in range(MORTON_BITS):
+        half = size * 0.5
+        quadtree = aabb_size_to_subdivision_type(half) == SubdivisionType.QUADTREE
+        splits.append(not quadtree)
+        size = np.array([half[0], half[1], size[2] if quadtree else half[2]])
+    return splits
+
+
+def morton_codes(xyz, aabb):
+    """Returns the Morton code of each point, quantized in aabb
+
+    The x, y and z bits are interleaved in this order, like the child
+    indices of the nodes (see xyz_to_child_index), and z only gets a bit at
+    the octree levels: sorted points are sorted by child at every level of
+    the tree made by splitting aabb (see split_aabb), and the points of a
+    node at depth d share the 3 * d highest bits of their codes.
+    """
+    splits = _z_splits(aabb)
+    cells = np.array([1 << MORTON_BITS, 1 << MORTON_BITS, 1 << sum(splits)])
+    quantized = (xyz - aabb[0]) * (cells / np.maximum(aabb[1] - aabb[0], 1e-9))
+    quantized = np.clip(quantized, 0, cells - 1).astype(np.uint64)
+
+    if all(splits):
+        z = _spread_bits(quantized[:, 2])
+    else:
+        z = np.zeros(len(xyz), dtype=np.uint64)
+        bit = sum(splits)
+        for level, split in enumerate(splits):
+            if split:
+                bit -= 1
+                z |= ((quantized[:, 2] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * (MORTON_BITS - 1 - level))
+    x = _spread_bits(quantized[:, 0]) << np.uint64(2)
+    y = _spread_bits(quantized[:, 1]) << np.uint64(1)
+    return x | y | z
+
+
+def morton_sort(xyz, rgb, aabb):
+    """Returns xyz and rgb sorted by Morton code in aabb"""
+    order = np.argsort(morton_codes(xyz, aabb), kind='stable')
+    return xyz[order], rgb[order]
+
+
 def compute_spacing(aabb):
     return float(np.linalg.norm(aabb[1] - aabb[0]) / 125)
 
@@ -0,0 +1,41 @@
+import argparse
+import multiprocessing
+from py3dtiles.convert import remote_zmq_process, CONFIG_TIMEOUT
+
+
+def init_parser(subparser, str2bool):
+    parser = subparser.add_parser(
+        'worker',
+        help='Start workers for a convert running on another host (see convert --bind).',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--connect',
+        help='Endpoint of the convert process, e.g. tcp://host:5555',
+        required=True,
+        type=str)
+    parser.add_argument(
+        '--jobs',
+        help='The number of parallel jobs to start. Default to the number of cpu.',
+        default=multiprocessing.cpu_count(),
+        type=int)
+    parser.add_argument(
+        '--threads',
+        help='The number of threads of each job (see convert --threads).',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--config_timeout',
+        help='Seconds to wait for the convert process, the workers exit after that.',
+        default=CONFIG_TIMEOUT,
+        type=float)
+
+
+def main(args):
+    processes = [multiprocessing.Process(
+        target=remote_zmq_process,
+        args=(args.connect, args.verbose, args.threads, args.config_timeout)) for i in range(args.jobs)]
+
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
@@ -20,12 +20,21 @@ requirements = (
     'pyzmq'
 )
 
+laz_requirements = (
+    'lazrs',
+)
+
+zstd_requirements = (
+    'zstandard',
+)
+
+# the tests cover the optional dependencies too
 dev_requirements = (
     'pytest',
     'pytest-cov',
     'pytest-benchmark',
     'line_profiler'
-)
+) + laz_requirements + zstd_requirements
 
 doc_requirements = (
     'sphinx',
@@ -75,7 +84,9 @@ setup(
     test_suite="tests",
     extras_require={
         'dev': dev_requirements,
-        'doc': doc_requirements
+        'doc': doc_requirements,
+        'laz': laz_requirements,
+        'zstd': zstd_requirements,
     },
     entry_points={
         'console_scripts': ['py3dtiles=py3dtiles.command_line:main'],
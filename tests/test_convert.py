@@ -1,10 +1,27 @@
 # -*- coding: utf-8 -*-
 import os
+import multiprocessing
+import socket
 from pytest import approx, raises
 import shutil
+import numpy as np
 
-from py3dtiles import convert_to_ecef
-from py3dtiles.convert import convert, SrsInMissingException
+from py3dtiles import convert_to_ecef, TileContentReader
+from py3dtiles.convert import convert, remote_zmq_process, SrsInMissingException, State, spill_tasks, task_frames, per_file_folder_names, MODES
+from py3dtiles.points.shared_node_store import SharedNodeStore
+from py3dtiles.points.utils import points_to_frames
+from py3dtiles.points.task.xyz_reader import OutsideAabbException
+
+
+def pnts_point_count(folder):
+    """Returns the point count of the tiles of a tileset, except r.pnts which is made of points of its children"""
+    point_count = 0
+    for root, _, files in os.walk(folder):
+        for f in files:
+            if f.endswith('.pnts') and f != 'r.pnts':
+                tile = TileContentReader.read_file(os.path.join(root, f))
+                point_count += tile.body.feature_table.header.points_length
+    return point_count
 
 
 def test_convert_to_ecef():
@@ -26,6 +43,116 @@ def test_convert():
     shutil.rmtree('./tmp')
 
 
+def test_convert_metadata_cache(tmp_path):
+    cache = tmp_path / 'cache.json'
+    convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ripple.las'),
+            outfolder=str(tmp_path / 'out'),
+            metadata_cache=str(cache))
+    assert os.path.exists(str(tmp_path / 'out' / 'tileset.json'))
+    assert os.path.exists(str(cache))
+
+
+def test_convert_laz():
+    convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ripple.laz'), outfolder='./tmp')
+    assert os.path.exists(os.path.join('tmp', 'tileset.json'))
+    assert os.path.exists(os.path.join('tmp', 'r0.pnts'))
+    shutil.rmtree('./tmp')
+
+
+def test_convert_staging_dir(tmp_path):
+    convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las'),
+            outfolder='./tmp',
+            staging_dir=str(tmp_path))
+    assert os.path.exists(os.path.join('tmp', 'tileset.json'))
+    assert os.path.exists(os.path.join('tmp', 'r0.pnts'))
+    assert not list(tmp_path.iterdir())
+    shutil.rmtree('./tmp')
+
+
+def test_convert_xyz(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((5000, 3)) * 10
+    np.savetxt(filename, np.hstack((xyz, np.full((5000, 3), 128))), fmt='%.4f')
+
+    convert(filename, outfolder='./tmp')
+    assert os.path.exists(os.path.join('tmp', 'tileset.json'))
+    assert os.path.exists(os.path.join('tmp', 'r.pnts'))
+    shutil.rmtree('./tmp')
+
+
+def test_convert_threads(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((60000, 3)) * 10
+    np.savetxt(filename, np.hstack((xyz, np.full((60000, 3), 128))), fmt='%.4f')
+
+    convert(filename, outfolder=str(tmp_path / 'out'), jobs=1, threads=4)
+    assert pnts_point_count(str(tmp_path / 'out')) == 60000
+
+
+def test_convert_morton_sort(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((60000, 3)) * 10
+    np.savetxt(filename, np.hstack((xyz, np.full((60000, 3), 128))), fmt='%.4f')
+
+    for morton_sort in (False, True):
+        out = str(tmp_path / 'out-{}'.format(morton_sort))
+        convert(filename, outfolder=out, morton_sort=morton_sort)
+        assert os.path.exists(os.path.join(out, 'tileset.json'))
+        # the sort changes which points each node keeps, not the point count
+        assert pnts_point_count(out) == 60000
+
+
+def test_convert_external_sort(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((60000, 3)) * 10
+    # enough points in r0 to split it
+    xyz[:30000] *= 0.2
+    np.savetxt(filename, np.hstack((xyz, np.full((60000, 3), 128))), fmt='%.4f')
+
+    out = tmp_path / 'out'
+    convert(filename, outfolder=str(out), jobs=2, mode='external-sort')
+    assert os.path.exists(str(out / 'tileset.json'))
+    assert not os.path.exists(str(out / 'tmp'))
+
+    assert pnts_point_count(str(out)) == 60000
+    # r0 keeps a subsample of the points of its children
+    assert os.path.exists(str(out / 'r0.pnts'))
+    assert os.path.exists(str(out / 'r00.pnts'))
+
+
+def test_convert_external_sort_single_pass(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    # lines of different lengths
+    np.savetxt(filename, np.random.random((5000, 3)) * 100, fmt='%.4f')
+
+    # the point count is estimated from the file size, then corrected by the readers
+    convert(filename, outfolder=str(tmp_path / 'out'), mode='external-sort', single_pass=True,
+            aabb=[0, 0, 0, 100, 100, 100])
+    assert os.path.exists(str(tmp_path / 'out' / 'tileset.json'))
+
+
+def test_convert_single_pass_outside_aabb(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    np.savetxt(filename, np.random.random((5000, 3)) * 100, fmt='%.4f')
+
+    # points would be clamped in the wrong nodes
+    for mode in MODES:
+        with raises(OutsideAabbException):
+            convert(filename, outfolder=str(tmp_path / 'out'), overwrite=True, mode=mode, single_pass=True,
+                    aabb=[0, 0, 0, 50, 100, 100])
+
+
+def test_convert_xyz_single_pass(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((5000, 3)) * 10
+    np.savetxt(filename, np.hstack((xyz, np.full((5000, 3), 128))), fmt='%.4f')
+
+    convert(filename, outfolder='./tmp', single_pass=True, aabb=[0, 0, 0, 10, 10, 10])
+    assert os.path.exists(os.path.join('tmp', 'tileset.json'))
+    assert os.path.exists(os.path.join('tmp', 'r.pnts'))
+    shutil.rmtree('./tmp')
+
+
 def test_convert_without_srs():
     with raises(SrsInMissingException):
         convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'without_srs.las'),
@@ -40,3 +167,92 @@ def test_convert_without_srs():
     assert os.path.exists(os.path.join('tmp', 'tileset.json'))
     assert os.path.exists(os.path.join('tmp', 'r.pnts'))
     shutil.rmtree('./tmp')
+
+
+def test_convert_remote_workers():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    endpoint = 'tcp://127.0.0.1:{}'.format(port)
+
+    workers = [multiprocessing.Process(target=remote_zmq_process, args=(endpoint, 0, 1, 5)) for i in range(2)]
+    for w in workers:
+        w.start()
+
+    convert(os.path.join(os.path.dirname(os.path.abspath(__file__)), './ripple.las'),
+            outfolder='./tmp',
+            jobs=0,
+            bind=endpoint)
+    # a worker that connects after the end of the conversion exits too
+    late_worker = multiprocessing.Process(target=remote_zmq_process, args=(endpoint, 0, 1, 1))
+    late_worker.start()
+    for w in workers + [late_worker]:
+        w.join(timeout=10)
+        assert w.exitcode == 0
+    assert os.path.exists(os.path.join('tmp', 'tileset.json'))
+    assert os.path.exists(os.path.join('tmp', 'r0.pnts'))
+    shutil.rmtree('./tmp')
+
+
+def test_convert_per_file(tmp_path):
+    filenames = []
+    for name in ('a', 'b', 'c'):
+        filename = str(tmp_path / '{}.xyz'.format(name))
+        np.savetxt(filename, np.random.random((2000, 3)) * 10, fmt='%.4f')
+        filenames.append(filename)
+
+    convert(filenames, outfolder='./tmp', jobs=2, per_file=True, max_concurrent_runs=2)
+    for name in ('a', 'b', 'c'):
+        assert os.path.exists(os.path.join('tmp', name, 'tileset.json'))
+        assert not os.path.exists(os.path.join('tmp', name, 'tmp'))
+    shutil.rmtree('./tmp')
+
+
+def test_convert_per_file_same_names(tmp_path):
+    filenames = []
+    for folder in ('a', 'b'):
+        os.mkdir(str(tmp_path / folder))
+        filename = str(tmp_path / folder / 'tile.xyz')
+        np.savetxt(filename, np.random.random((2000, 3)) * 10, fmt='%.4f')
+        filenames.append(filename)
+
+    out = tmp_path / 'out'
+    convert(filenames, outfolder=str(out), jobs=2, per_file=True, max_concurrent_runs=2)
+    assert sorted(os.listdir(str(out))) == ['tile-1', 'tile-2']
+    for name in ('tile-1', 'tile-2'):
+        assert os.path.exists(str(out / name / 'tileset.json'))
+
+    assert per_file_folder_names(['x.las', 'x.laz', 'x-1.las', 'y.xyz']) == ['x-2', 'x-3', 'x-1', 'y']
+
+
+def test_spill_tasks(tmp_path):
+    store = SharedNodeStore(str(tmp_path))
+    state = State([])
+    xyz = np.random.random((1000, 3)).astype(np.float32)
+    rgb = np.random.randint(0, 255, (1000, 3), dtype=np.uint8)
+    staging_dir = str(tmp_path / 'staging')
+    os.mkdir(staging_dir)
+    batches = [
+        [bytes(f) for f in points_to_frames(xyz, rgb)],
+        [bytes(f) for f in points_to_frames(xyz[:10], rgb[:10])],
+        points_to_frames(xyz, rgb, staging_dir),
+    ]
+    state.node_process.input[b'0'] = (list(batches[0:1]), 1000)
+    state.node_process.input[b'01'] = (list(batches[1:]), 1010)
+    state.pending_task_bytes = sum(len(f) for f in batches[0] + batches[1])
+
+    # the pending batches count in the memory budget
+    assert store.control_memory_usage(0, 0, 300 * 1024 * 1024) > 0
+
+    # the deepest node is spilled first, its staged batch is kept as is
+    assert spill_tasks(state, store, 1) == 10 * 15 + 5
+    assert state.pending_task_bytes == 1000 * 15 + 5
+    assert state.node_process.input[b'01'][0][1] == batches[2]
+    spill_tasks(state, store, 1000000)
+    assert state.pending_task_bytes == 0
+
+    for name in (b'0', b'01'):
+        for task, batch in zip(state.node_process.input[name][0], batches[len(name) - 1:]):
+            assert [bytes(f) for f in task_frames(state, store, task)] == [bytes(f) for f in batch]
+    assert not store.writing and not store.disk.index
+    store.close()
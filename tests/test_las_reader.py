@@ -0,0 +1,100 @@
+import os
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+from laspy.file import File
+
+from py3dtiles.points.task import las_reader, laz_reader
+
+RIPPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ripple.las')
+RIPPLE_LAZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ripple.laz')
+WITHOUT_SRS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'without_srs.las')
+
+
+def read_reference(start, end):
+    f = File(RIPPLE, mode='r')
+    header = {
+        'dtype': las_reader.point_dtype(f.header.data_format_id, f.header.data_record_length),
+        'data_offset': f.header.data_offset,
+        'scale': np.array(f.header.scale),
+        'offset': np.array(f.header.offset),
+    }
+    points = f.get_points()['point'][start:end].copy()
+    f.close()
+    return header, points
+
+
+def test_point_dtype():
+    for point_format, record_length in [(0, 20), (1, 28), (2, 26), (3, 34), (6, 30), (7, 36), (8, 38)]:
+        assert las_reader.point_dtype(point_format, record_length).itemsize == record_length
+        assert las_reader.point_dtype(point_format, record_length + 4).itemsize == record_length + 4
+
+
+def test_read_portion():
+    header, reference = read_reference(1000, 5500)
+    chunks = list(las_reader.read_portion(RIPPLE, header['dtype'], header['data_offset'], (1000, 5500), 1000))
+
+    assert [len(c) for c in chunks] == [1000, 1000, 1000, 1000, 500]
+    points = np.concatenate(chunks)
+    for field in ('X', 'Y', 'Z', 'intensity', 'gps_time', 'red', 'green', 'blue'):
+        assert_array_equal(points[field], reference[field])
+
+
+def test_decode():
+    header, reference = read_reference(0, 1000)
+    points = next(las_reader.read_portion(RIPPLE, header['dtype'], header['data_offset'], (0, 1000), 1000))
+    offset_scale = (np.array([5, 5, 0.5]), np.array([0.1, 0.1, 0.1]), None, 1.0 / 255)
+
+    xyz = las_reader.decode_xyz(points, header['scale'], header['offset'], offset_scale, None)
+    rgb = las_reader.decode_rgb(points, ('red', 'green', 'blue'), offset_scale[3])
+
+    assert xyz.dtype == np.float32 and xyz.shape == (1000, 3)
+    for i, field in enumerate(('X', 'Y', 'Z')):
+        expected = (reference[field] * header['scale'][i] + header['offset'][i] + offset_scale[0][i]) * offset_scale[1][i]
+        assert_allclose(xyz[:, i], expected, rtol=1e-6, atol=1e-6)
+        assert_array_equal(rgb[:, i], (reference[('red', 'green', 'blue')[i]] * offset_scale[3]).astype(np.uint8))
+
+
+def test_laz_read_chunks():
+    _, reference = read_reference(0, 10201)
+    header = laz_reader.read_header(RIPPLE_LAZ)
+    chunks = laz_reader.read_chunk_table(RIPPLE_LAZ, header)
+
+    assert header['point_format'] == 3
+    assert header['point_count'] == 10201
+    assert [c[0] for c in chunks] == [3000, 3000, 3000, 1201]
+
+    points = laz_reader.read_chunks(RIPPLE_LAZ, header, chunks[1:3])
+    for field in ('X', 'Y', 'Z', 'red', 'green', 'blue'):
+        assert_array_equal(points[field], reference[field][3000:9000])
+
+
+def test_laz_init():
+    infos = laz_reader.init([RIPPLE_LAZ], fraction=50)
+    assert infos['point_count'] == 5100
+    assert [p[0:2] for _, p in infos['portions']] == [(0, 5100)]
+    assert len(infos['portions'][0][1][2]) == 2
+
+
+def test_init_portion_size():
+    infos = las_reader.init([RIPPLE], metadata_cache=None, portion_size=4000)
+    assert [p for _, p in infos['portions']] == [(0, 4000), (4000, 8000), (8000, 10201)]
+
+
+def test_init_metadata_cache(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache.json')
+    files = [RIPPLE, WITHOUT_SRS]
+    infos = las_reader.init(files, metadata_cache=cache)
+
+    assert infos['point_count'] == 10211
+    assert infos['color_scale'] == 1.0 / 255
+    assert [p for _, p in infos['portions']] == [(0, 10201), (0, 10)]
+    assert os.path.exists(cache)
+
+    # files are not read again on the next runs
+    def read_metadata(filename, read_srs):
+        raise AssertionError('{} should be in the cache'.format(filename))
+    monkeypatch.setattr(las_reader, 'read_metadata', read_metadata)
+
+    cached_infos = las_reader.init(files, metadata_cache=cache)
+    assert cached_infos['point_count'] == infos['point_count']
+    assert_array_equal(cached_infos['aabb'], infos['aabb'])
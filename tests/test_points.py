@@ -1,11 +1,23 @@
+import os
+import concurrent.futures
+import pickle
 import pytest
 import numpy as np
 from numpy.testing import assert_array_equal
 
 from py3dtiles.points.points_grid import Grid
 from py3dtiles.points.node import Node
-from py3dtiles.points.utils import compute_spacing
-from py3dtiles.points.distance import is_point_far_enough
+from py3dtiles.points.utils import compute_spacing, points_to_frames, frames_to_points, points_frame_count, morton_sort, morton_codes, split_aabb
+from py3dtiles.points.distance import is_point_far_enough, xyz_to_key, xyz_to_child_index, partition
+from py3dtiles.points.task.node_process import CatalogCache
+from py3dtiles.points.task import node_process
+from py3dtiles.points.node_catalog import NodeCatalog
+from py3dtiles.convert import OctreeMetadata
+from py3dtiles.points.task.pnts_writer import node_bytes_to_points
+from py3dtiles.points.job_controller import JobController, MIN_NODE_JOB_POINTS
+from py3dtiles.points.shared_node_store import SharedNodeStore
+from py3dtiles.points.segment_store import SegmentStore
+from py3dtiles.points import codec, external_sort
 
 # test point
 xyz = np.array([0.25, 0.25, 0.25], dtype=np.float32)
@@ -60,6 +72,174 @@ def test_grid_get_point_count(grid, node):
     assert len(grid.get_points(False)) == 1 * (3 * 4)
 
 
+def test_node_save_load():
+    bbox = np.array([[0, 0, 0], [2, 2, 2]])
+    random = np.random.RandomState(0)
+    points_xyz = random.random_sample((1000, 3)).astype(np.float32) * 2
+    points_rgb = random.randint(0, 255, (1000, 3)).astype(np.uint8)
+
+    leaf = Node(b'0', bbox, compute_spacing(bbox))
+    leaf.points = [(points_xyz[:10], points_rgb[:10]), (points_xyz[10:20], points_rgb[10:20])]
+    loaded = Node(b'0', bbox, compute_spacing(bbox))
+    loaded.load_from_bytes(leaf.save_to_bytes())
+    assert loaded.children is None
+    assert_array_equal(Node.get_points(loaded, True), Node.get_points(leaf, True))
+
+    node = Node(b'0', bbox, compute_spacing(bbox))
+    node.children = [b'03', b'05']
+    node.grid.insert(node.aabb[0], node.inv_aabb_size, points_xyz, points_rgb)
+    data = node.save_to_bytes()
+    loaded = Node(b'0', bbox, compute_spacing(bbox))
+    loaded.load_from_bytes(data)
+    assert loaded.children == [b'03', b'05']
+    assert_array_equal(loaded.grid.cell_count, node.grid.cell_count)
+    for a, b in zip(loaded.grid.to_arrays(), node.grid.to_arrays()):
+        assert_array_equal(a, b)
+    assert_array_equal(node_bytes_to_points(data, True), node.grid.get_points(True))
+
+    # the loaded cells can still be inserted into
+    count = len(loaded.grid.get_points(False))
+    loaded.grid.insert(node.aabb[0], node.inv_aabb_size, points_xyz[::-1] * 0.999, points_rgb)
+    assert len(loaded.grid.get_points(False)) > count
+
+
+def test_grid_insert_matches_linear_scan():
+    bbox = np.array([[0, 0, 0], [2, 2, 2]])
+    node = Node(b'0', bbox, 0.05)
+    random = np.random.RandomState(0)
+    points_xyz = (random.random_sample((3000, 3)) * 2).astype(np.float32)
+    points_rgb = np.zeros((3000, 3), dtype=np.uint8)
+    remainder = node.grid.insert(node.aabb[0], node.inv_aabb_size, points_xyz, points_rgb)[0]
+
+    # reference: each point is compared to all the points of its cell
+    keys = xyz_to_key(points_xyz, node.grid.cell_count, node.aabb[0], node.inv_aabb_size, 2)
+    cells = {}
+    expected = []
+    for key, point in zip(keys, points_xyz):
+        cell = cells.setdefault(key, np.zeros((0, 3), dtype=np.float32))
+        if len(cell) == 0 or is_point_far_enough(cell, point, np.float32(node.grid.spacing)):
+            cells[key] = np.concatenate((cell, point.reshape(1, 3)))
+        else:
+            expected.append(point)
+    assert len(remainder) > 0
+    assert_array_equal(remainder, np.array(expected))
+
+
+def test_grid_insert_reserves_cells_once(grid, node):
+    points_xyz = (np.random.RandomState(0).random_sample((1000, 3)) * 2).astype(np.float32)
+    grid.insert(node.aabb[0], node.inv_aabb_size, points_xyz, np.zeros((1000, 3), dtype=np.uint8), True)
+    # each cell was sized for its points when the first one was inserted
+    used = grid.counts > 0
+    assert_array_equal(grid.capacities[used], np.maximum(grid.counts[used], 16))
+    assert grid.get_point_count() == 1000
+
+
+class _Queue():
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, frames, **kwargs):
+        self.messages.append([bytes(f) for f in frames])
+
+
+def test_process_subtrees_in_threads():
+    aabb = np.array([[0, 0, 0], [8, 8, 8]], dtype=np.float32)
+    octree_metadata = OctreeMetadata(aabb=aabb, spacing=compute_spacing(aabb), scale=1)
+    random = np.random.RandomState(0)
+    # points of the node 000, sent to a node deep enough to fill its children subtrees
+    points_xyz = (random.random_sample((50000, 3)) * 2).astype(np.float32)
+    points_rgb = random.randint(0, 255, (50000, 3)).astype(np.uint8)
+    batches = [points_to_frames(points_xyz[i:i + 10000], points_rgb[i:i + 10000]) for i in range(0, 50000, 10000)]
+
+    results = []
+    for executor in (None, concurrent.futures.ThreadPoolExecutor(max_workers=4)):
+        catalog = NodeCatalog(b'', b'000', octree_metadata)
+        queue = _Queue()
+        total, data = node_process._process(catalog, octree_metadata, b'000', batches, queue, 0, None, executor=executor)
+        results.append((total, pickle.loads(data), sorted(m[0] for m in queue.messages)))
+
+    assert results[0][0] == results[1][0]
+    assert results[0][1] == results[1][1]
+    assert results[0][2] == results[1][2]
+    assert len(results[0][1]) > 1
+
+
+def test_morton_sort():
+    aabb = np.array([[0, 0, 0], [2, 2, 2]], dtype=np.float32)
+    random = np.random.RandomState(0)
+    points_xyz = (random.random_sample((5000, 3)) * 2).astype(np.float32)
+    points_rgb = np.arange(5000 * 3).astype(np.uint8).reshape((5000, 3))
+    sorted_xyz, sorted_rgb = morton_sort(points_xyz, points_rgb, aabb)
+
+    # sorted by octant, then by octant of the octant
+    indices = xyz_to_child_index(sorted_xyz, np.array([1, 1, 1], dtype=np.float32))
+    assert np.all(indices[:-1] <= indices[1:])
+    first = sorted_xyz[indices == 0]
+    assert np.all(np.diff(xyz_to_child_index(first, np.array([0.5, 0.5, 0.5], dtype=np.float32))) >= 0)
+    order = np.lexsort(points_xyz.T)
+    assert_array_equal(sorted_xyz[np.lexsort(sorted_xyz.T)], points_xyz[order])
+    assert_array_equal(sorted_rgb[np.lexsort(sorted_xyz.T)], points_rgb[order])
+
+    # the nodes split sorted points by slicing them, with the same result
+    node = Node(b'0', aabb, 0.1)
+    node.children = []
+    node.pending_xyz, node.pending_rgb = [sorted_xyz], [sorted_rgb]
+    by_slices = node.take_pending_points()
+    # unsorted points (first and last swapped) are split with masks
+    swapped_xyz, swapped_rgb = sorted_xyz.copy(), sorted_rgb.copy()
+    swapped_xyz[[0, -1]], swapped_rgb[[0, -1]] = sorted_xyz[[-1, 0]], sorted_rgb[[-1, 0]]
+    node.pending_xyz, node.pending_rgb = [swapped_xyz], [swapped_rgb]
+    by_masks = node.take_pending_points()
+    assert [c[0] for c in by_slices] == [c[0] for c in by_masks] == [b'0' + str(i).encode() for i in range(8)]
+    for (_, xyz_a, rgb_a), (_, xyz_b, rgb_b) in zip(by_slices[1:-1], by_masks[1:-1]):
+        assert_array_equal(xyz_a, xyz_b)
+        assert_array_equal(rgb_a, rgb_b)
+
+
+def test_morton_codes_quadtree():
+    # flat aabb: the first levels only split x and y (see split_aabb)
+    aabb = np.array([[0, 0, 0], [8, 8, 1]], dtype=np.float64)
+    xyz = np.random.RandomState(0).random_sample((1000, 3)) * [8, 8, 1]
+    codes = morton_codes(xyz, aabb)
+
+    for point, code in zip(xyz, codes):
+        node_aabb = aabb
+        for depth in range(6):
+            node_aabb = split_aabb(node_aabb, int(code >> np.uint64(3 * (20 - depth))) & 7)
+            assert np.all(point >= node_aabb[0]) and np.all(point <= node_aabb[1])
+
+
+def test_external_sort_merge(tmp_path):
+    aabb = np.array([[0, 0, 0], [2, 2, 2]], dtype=np.float32)
+    random = np.random.RandomState(0)
+    xyz = (random.random_sample((5000, 3)) * 2).astype(np.float32)
+    rgb = random.randint(0, 255, (5000, 3)).astype(np.uint8)
+
+    writer = external_sort._RunWriter(str(tmp_path), 'run', aabb, 1000)
+    for i in range(0, 5000, 700):
+        writer.send_multipart([b''] + points_to_frames(xyz[i:i + 700], rgb[i:i + 700]))
+        writer.send_multipart([pickle.dumps({'name': b'run', 'total': 0, 'point_count_delta': 1})])
+        writer.send_multipart([b''])
+    writer.flush()
+    assert [c for _, c in writer.runs] == [1400, 1400, 1400, 800]
+    assert writer.point_count_delta == 8
+
+    # 2 passes
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        filename, count = external_sort.merge(executor, writer.runs, str(tmp_path), fan_in=3)
+    assert count == 5000
+    assert os.listdir(str(tmp_path)) == [os.path.basename(filename)]
+
+    codes, merged_xyz, merged_rgb = external_sort.open_run(filename)
+    expected = np.argsort(morton_codes(xyz, aabb), kind='stable')
+    assert_array_equal(codes, morton_codes(xyz, aabb)[expected])
+    # points with the same code may be swapped
+    merged = np.lexsort((merged_xyz[:, 2], merged_xyz[:, 1], merged_xyz[:, 0]))
+    reference = np.lexsort((xyz[:, 2], xyz[:, 1], xyz[:, 0]))
+    assert_array_equal(merged_xyz[merged], xyz[reference])
+    assert_array_equal(merged_rgb[merged], rgb[reference])
+
+
 def test_is_point_far_enough():
     points = np.array(
         [
@@ -73,3 +253,172 @@ def test_is_point_far_enough():
 
 def test_is_point_far_enough_perf(benchmark):
     benchmark(is_point_far_enough, sample_points, xyz, 0.25 ** 2)
+
+
+def test_partition():
+    keys = np.random.RandomState(0).randint(0, 8, 1000)
+    order, bounds = partition(keys, 10)
+
+    assert_array_equal(order, np.argsort(keys, kind='mergesort'))
+    assert_array_equal(bounds, np.searchsorted(np.sort(keys), np.arange(11)))
+    assert bounds[8] == bounds[10] == 1000
+
+
+def test_node_pending_points_by_child():
+    node = Node(b'0', np.array([[0, 0, 0], [2, 2, 2]]), 0.5)
+    node.children = []
+    xyz = (np.random.RandomState(0).random_sample((500, 3)) * 2).astype(np.float32)
+    rgb = np.arange(1500).reshape(500, 3).astype(np.uint8)
+    node.pending_xyz, node.pending_rgb = [xyz[:200], xyz[200:]], [rgb[:200], rgb[200:]]
+
+    result = node.take_pending_points()
+    indices = xyz_to_child_index(xyz, node.aabb_center)
+    assert [name for name, _, _ in result] == [b'0' + str(c).encode('ascii') for c in np.unique(indices)]
+    for name, child_xyz, child_rgb in result:
+        mask = indices == int(name[-1:])
+        assert_array_equal(child_xyz, xyz[mask])
+        assert_array_equal(child_rgb, rgb[mask])
+
+
+def test_points_frames(tmp_path):
+    rgb = np.arange(90, dtype=np.uint8).reshape((30, 3))
+    frames = [bytes(memoryview(f)) for f in points_to_frames(sample_points, rgb)]
+    assert len(frames) == points_frame_count(frames[0]) == 3
+
+    xyz2, rgb2 = frames_to_points(frames)
+    assert_array_equal(xyz2, sample_points)
+    assert_array_equal(rgb2, rgb)
+
+    # staged batches
+    frames = points_to_frames(sample_points, rgb, str(tmp_path))
+    assert len(frames) == points_frame_count(frames[0]) == 2
+    assert len(list(tmp_path.iterdir())) == 1
+
+    xyz2, rgb2 = frames_to_points(frames)
+    assert_array_equal(xyz2, sample_points)
+    assert_array_equal(rgb2, rgb)
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_catalog_cache():
+    cache = CatalogCache(size=2)
+    cache.put(b'', 'root')
+    cache.put(b'0', 'a')
+    cache.put(b'1', 'b')
+    cache.put(b'0', 'c')
+    cache.put(b'2', 'd')
+
+    # the root node is never cached, and the least recently put node is evicted first
+    assert b'' not in cache
+    assert b'1' not in cache
+    assert cache.get(b'0') == 'c'
+    assert cache.get(b'2') == 'd'
+
+
+def test_job_controller():
+    controller = JobController(8)
+    assert controller.portion_size() % 100000 == 0
+
+    # jobs are sized from the measured throughput...
+    controller.node_job_done(200000, 1.0)
+    assert controller.node_job_size(10000000, 1) == 100000
+    # ... and shared between the idle workers
+    assert controller.node_job_size(200000, 4) == 50000
+    assert controller.node_job_size(1000, 4) == MIN_NODE_JOB_POINTS
+
+    # a reader is always admitted when none is running
+    assert controller.can_admit_portion(10 ** 15, 0)
+    assert not controller.can_admit_portion(10 ** 15, 1)
+
+    # idle workers => more readers
+    max_readers = controller.max_readers
+    controller.idle_time, controller.worker_time = 8, 8
+    controller.update(8, 0, 10)
+    assert controller.max_readers == max_readers + 1
+    # too many pending points => less readers
+    controller.idle_time, controller.worker_time = 0, 8
+    controller.update(8, 10 ** 9, 10)
+    assert controller.max_readers == max_readers
+
+
+def test_shared_node_store_eviction(tmp_path):
+    store = SharedNodeStore(str(tmp_path))
+    data = {name: np.random.bytes(10000) for name in (b'0', b'1', b'2')}
+    for name in (b'0', b'1', b'2'):
+        store.put(name, data[name])
+    # b'1' is now the least recently used
+    store.get(b'0')
+
+    count, _ = store.remove_oldest_nodes(0.2)
+    assert count == 1
+    assert b'1' not in store.metadata
+    assert sorted(store.metadata) == [b'0', b'2']
+
+    # the freed slot is reused
+    store.put(b'3', data[b'0'])
+    assert len(store.data) == 3
+
+    # evicted nodes are read back from disk, possibly in advance
+    concurrent.futures.wait([w[0] for w in store.writing.values()])
+    store.control_memory_usage(1000, 0)
+    assert not store.writing
+    assert codec.decompress(store.get(b'1')) == data[b'1']
+    assert store.stats['miss'] == 1
+    store.prefetch([b'1', b'4'])
+    assert codec.decompress(store.get(b'1')) == data[b'1']
+    assert store.get(b'4') == b''
+    assert store.stats['prefetch'] == 1
+    assert store.stats['new'] == 1
+    store.close()
+
+
+def test_segment_store(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=100)
+    store.write(b'0', b'a' * 60)
+    store.write(b'1', b'b' * 60)
+    store.write(b'2', b'c' * 60)
+    assert len(store.segments) == 3
+
+    # overwriting or removing all the nodes of a segment deletes it
+    store.write(b'0', b'd' * 10)
+    assert len(store.segments) == 2
+    assert store.read(b'0') == b'd' * 10
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    # mostly dead segments are compacted
+    store.write(b'3', b'e' * 90)
+    store.write(b'2', b'f' * 10)
+    store.remove(b'1')
+    assert b'1' not in store
+    assert store.read(b'1') is None
+    assert store.needs_compaction()
+    store.compact()
+    assert not store.needs_compaction()
+    assert [store.read(n) for n in (b'0', b'2', b'3')] == [b'd' * 10, b'f' * 10, b'e' * 90]
+
+    store.close()
+    assert not os.listdir(str(tmp_path))
+
+
+def test_codecs():
+    random = np.random.RandomState(0)
+    samples = [random.randint(0, 10, 10000).astype(np.uint8).tobytes() for _ in range(50)]
+    for name in codec.CODECS:
+        c = codec.Codec(name, sample_size=len(samples[0]) * 10)
+        for sample in samples:
+            # the payloads can be decompressed without knowing the codec
+            assert codec.decompress(c.compress(sample)) == sample
+    # zstd is trained on the first payloads, then forgets them
+    assert c.dictionary is not None
+    assert c.samples == []
+    assert codec.decompress(memoryview(c.compress(samples[0]))) == samples[0]
+
+    # the samples are only kept for the benchmark
+    for keep_samples in (False, True):
+        c = codec.Codec('lz4', keep_samples=keep_samples)
+        c.compress(samples[0])
+        assert c.samples == ([samples[0]] if keep_samples else [])
+
+    results = codec.benchmark(samples)
+    assert [r[0] for r in results] == list(codec.CODECS)
+    assert results[0][1] < 1 < results[1][1]
@@ -0,0 +1,124 @@
+import os
+import pickle
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+from pytest import raises
+
+from py3dtiles.points.task import xyz_reader
+
+
+def test_parse_lines():
+    lines = [b'1.5 2 3\n', b'4\t5.25   6e2\n', b' 7 8 9']
+    assert_array_equal(
+        xyz_reader.parse_lines(lines),
+        np.array([[1.5, 2, 3], [4, 5.25, 600], [7, 8, 9]]))
+
+
+def test_parse_lines_columns():
+    for columns in (3, 4, 6, 7):
+        lines = [' '.join(str(i * columns + c) for c in range(columns)).encode('ascii') + b'\n' for i in range(10)]
+        points = xyz_reader.parse_lines(lines)
+        assert points.shape == (10, columns)
+        assert points[9][columns - 1] == 10 * columns - 1
+
+    with raises(ValueError):
+        xyz_reader.parse_lines([b'1 2 3\n', b'4 5 6 7\n'])
+
+
+def test_init(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((2500, 3)) * 100
+    np.savetxt(filename, np.hstack((xyz, np.full((2500, 3), 128))), fmt='%.6f')
+
+    infos = xyz_reader.init([filename])
+    assert infos['point_count'] == 2500
+    assert infos['portions'] == [(filename, (0, 2500, 0))]
+    assert_allclose(infos['aabb'], [xyz.min(axis=0), xyz.max(axis=0)], atol=1e-6)
+
+
+def test_read_byte_range(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((2500, 3)) * 100
+    np.savetxt(filename, xyz, fmt='%.3f')
+    size = os.path.getsize(filename)
+
+    # arbitrary splits, not aligned on lines
+    bounds = [0, 1, 777, 10000, 10001, 50000, size]
+    with open(filename, 'rb') as f:
+        points = [
+            p for start, end in zip(bounds[:-1], bounds[1:])
+            for p in xyz_reader._read_byte_range(f, start, end)]
+    assert_allclose(np.concatenate(points), xyz, atol=1e-3)
+
+
+def test_init_single_pass(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((2500, 3)) * 100
+    np.savetxt(filename, xyz, fmt='%.3f')
+
+    infos = xyz_reader.init([filename], single_pass=True)
+    bounds = tuple(infos['aabb'].ravel())
+    assert infos['portions'] == [(filename, (0, 2500, 0, os.path.getsize(filename), bounds))]
+    assert infos['point_count'] == 2500
+    assert_allclose(infos['aabb'], [xyz.min(axis=0), xyz.max(axis=0)], atol=1e-3)
+
+    with open(filename + '.aabb', 'w') as f:
+        f.write('-1 -1 -1 101 101 101\n')
+    infos = xyz_reader.init([filename], single_pass=True)
+    assert_allclose(infos['aabb'], [[-1, -1, -1], [101, 101, 101]])
+
+    infos = xyz_reader.init([filename], single_pass=True, aabb=np.array([[0, 0, 0], [100, 100, 100]]))
+    assert_allclose(infos['aabb'], [[0, 0, 0], [100, 100, 100]])
+    assert infos['portions'][0][1][4] == (0, 0, 0, 100, 100, 100)
+
+
+class _Queue():
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, frames, copy=True):
+        self.messages.append(frames)
+
+
+def test_run_outside_aabb(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((2500, 3)) * 100
+    xyz[:10, 2] = 150
+    np.savetxt(filename, xyz, fmt='%.3f')
+    size = os.path.getsize(filename)
+    offset_scale = (np.zeros(3), np.ones(3), None, None)
+
+    for bounds, outside in (((0, 0, 0, 100, 100, 100), 10), ((0, 0, 0, 100, 100, 150), 0)):
+        queue = _Queue()
+        xyz_reader.run(b'root_0', filename, offset_scale, (0, 2500, 0, size, bounds), queue, None, 0)
+        status = pickle.loads(queue.messages[-2][0])
+        assert status['outside_aabb'] == outside
+        assert status['point_count_delta'] == 0
+
+
+def test_init_single_pass_fraction(tmp_path):
+    filename = str(tmp_path / 'points.xyz')
+    xyz = np.random.random((20000, 3)) * 100
+    np.savetxt(filename, xyz, fmt='%.3f')
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offset_scale = (np.zeros(3), np.ones(3), None, None)
+
+    for fraction in (1, 33, 50):
+        size = int(len(data) * fraction / 100)
+        assert data[size - 1:size] != b'\n'
+        # the lines starting before size
+        expected = 1 + data[:size - 1].count(b'\n')
+
+        infos = xyz_reader.init([filename], single_pass=True, fraction=fraction)
+        assert abs(infos['point_count'] - expected) <= expected * 0.01
+        assert_allclose(infos['aabb'], [xyz[:expected].min(axis=0), xyz[:expected].max(axis=0)], atol=1e-3)
+
+        read_count = 0
+        for _, portion in infos['portions']:
+            queue = _Queue()
+            xyz_reader.run(b'root_0', filename, offset_scale, portion, queue, None, 0)
+            status = pickle.loads(queue.messages[-2][0])
+            assert status['outside_aabb'] == 0
+            read_count += portion[1] - portion[0] + status['point_count_delta']
+        assert read_count == expected